@@ -1,11 +1,16 @@
 import logging
 
 from ._version import __version__
+from .cache import ClientTokenCache, FindCache
+from .coalesce import SingleFlight
 from .namespace import Namespace
+from .ratelimit import RateLimiter
 from .shared import NamespaceError
+from .trace import RewriteTrace
 
 # appease flake8
-(Namespace, NamespaceError, __version__)
+(ClientTokenCache, FindCache, Namespace, NamespaceError, RateLimiter, RewriteTrace,
+ SingleFlight, __version__)
 
 __title__ = 'btnamespace'
 __author__ = 'Simon Weber'
@@ -1,28 +1,235 @@
+from builtins import filter, map, object
 import collections
+import functools
+import itertools
 import logging
+import operator
+import threading
 
 from bidict import namedbidict
 import braintree
 
-from .compat import getcallargs
+from .compat import getargnames, getcallargs
+from .shared import NamespaceError, ResourceId
 
 logger = logging.getLogger(__name__)
 
 IDMap = namedbidict('IDMap', 'fake_id', 'real_id')
+_empty_id_map = IDMap()
+
+# The longest id or token braintree accepts.
+MAX_ID_LENGTH = 36
+
+# Marks fake ids of resources whose id was generated by the gateway, when ids are derived.
+# It can't appear in ids braintree accepts, so it never collides with a provided id.
+GENERATED_ID_MARKER = '='
+
+
+class ClassLocks(object):
+    """Lazily-created locks, one per bt_class.
+
+    Writes to the state of one class never wait on writes to another,
+    and reads of id maps don't take a lock at all.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks = {}
+
+    def __getitem__(self, bt_class):
+        try:
+            return self._locks[bt_class]
+        except KeyError:
+            with self._lock:
+                return self._locks.setdefault(bt_class, threading.Lock())
+
+
+class _NoLock(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+_no_lock = _NoLock()
+
+
+def init_state(state, thread_safe=False):
+    """Initialize subitems of an action state dict that aren't already present.
+
+    :param thread_safe: if True, writes to the state are guarded by per-bt_class locks.
+    """
+
+    if 'id_maps' not in state:
+        state['id_maps'] = collections.defaultdict(IDMap)
+    if 'calls' not in state:
+        # Per-thread stacks of in-flight calls (see begin_call), and whether calls are paused.
+        state['calls'] = threading.local()
+    if 'owned_ids' not in state:
+        # bt_class -> OrderedDict of fake_id -> real_id, in creation order.
+        # Only resources created with a caller-provided id are recorded here.
+        state['owned_ids'] = collections.defaultdict(collections.OrderedDict)
+    if thread_safe and 'class_locks' not in state:
+        state['class_locks'] = ClassLocks()
+
+
+def class_lock(state, bt_class):
+    """Return a context manager guarding writes to bt_class's state."""
+
+    locks = state.get('class_locks')
+    if locks is None:
+        return _no_lock
+    return locks[bt_class]
+
+
+def _call_stack(state):
+    calls = state['calls']
+    try:
+        return calls.stack
+    except AttributeError:
+        calls.stack = [{}]
+        return calls.stack
+
+
+def begin_call(state):
+    """Start tracking the creation ids of a patched call made by this thread.
+
+    Calls are tracked individually so that concurrent creates - or creates made
+    while handling another call - each map their own response.
+    """
+    _call_stack(state).append({})
+
+
+def end_call(state):
+    _call_stack(state).pop()
+
+
+# The key of a call's frame which holds the classes it may create.
+_CREATING = 'creating'
+
+
+def mark_creating(state, bt_classes):
+    """Record that the current call may create resources of bt_classes.
+
+    Resources of these classes which the gateway names during the call are owned
+    by the namespace, just like those created with a provided id.
+    """
+    _call_stack(state)[-1][_CREATING] = frozenset(bt_classes)
+
+
+def creating_classes(schema_params, params=None):
+    """Return the classes whose creation ids schema_params removes, ie those a call
+    with them may create, including nested resources.
+
+    Given params, nested resources are only included when their params are present.
+    """
+    creating = set()
+    for key, val in schema_params.items():
+        if isinstance(val, ResourceId) and val.action is delete_and_store:
+            creating.add(val.bt_class)
+        elif isinstance(val, dict):
+            if params is None:
+                creating |= creating_classes(val)
+            elif isinstance(params.get(key), dict):
+                creating |= creating_classes(val, params[key])
+
+    return creating
+
+
+def _is_creating(state, bt_class):
+    return bt_class in _call_stack(state)[-1].get(_CREATING, ())
+
+
+def _pop_creation_id(state, bt_class):
+    # Responses may be built while a nested call is in flight, eg Transaction.sale
+    # calling Transaction.create, so look outward from the innermost call.
+    for creation_ids in reversed(_call_stack(state)):
+        if bt_class in creation_ids:
+            return creation_ids.pop(bt_class)
+    return None
+
+
+def derive_real_id(id_token, fake_id):
+    """Return the real id sent to the gateway for fake_id in the namespace id_token."""
+
+    if fake_id.startswith(GENERATED_ID_MARKER):
+        return fake_id[len(GENERATED_ID_MARKER):]
+
+    real_id = "%s_%s" % (id_token, fake_id)
+    if len(real_id) > MAX_ID_LENGTH:
+        raise NamespaceError("%r is too long to be namespaced with the id token %r;"
+                             " ids may have at most %s characters."
+                             % (fake_id, id_token, MAX_ID_LENGTH - len(id_token) - 1))
+    return real_id
+
+
+def derive_fake_id(id_token, real_id):
+    """Return the fake id of real_id in the namespace id_token. This inverts derive_real_id."""
+
+    prefix = id_token + '_'
+    if real_id.startswith(prefix):
+        return real_id[len(prefix):]
+
+    return GENERATED_ID_MARKER + real_id
+
+
+def lookup_real_id(state, bt_class, fake_id):
+    """Return the real id of fake_id, or fake_id itself if it isn't known."""
+
+    if state.get('id_token') is not None:
+        return derive_real_id(state['id_token'], fake_id)
+
+    return state['id_maps'].get(bt_class, _empty_id_map).fake_id_for.get(fake_id, fake_id)
+
+
+def _translate_ids(mapping, ids, missing):
+    # map and filter keep the per-id work in C.
+    if missing == 'keep':
+        ids, defaults = itertools.tee(ids)
+        return map(mapping.get, ids, defaults)
+    if missing == 'none':
+        return map(mapping.get, ids)
+    if missing == 'skip':
+        return filter(functools.partial(operator.is_not, None), map(mapping.get, ids))
+    return map(mapping.__getitem__, ids)
+
+
+def translate_ids(state, bt_class, ids, to_real, missing='keep'):
+    """Return an iterator over ids translated between fake and real ids, in order.
+
+    The id map is copied once, so ids are translated as they were mapped at the time of the call.
+    Derived ids are always translated, so missing has no effect on them.
+    """
+
+    if missing not in ('keep', 'none', 'skip', 'raise'):
+        raise ValueError("missing must be one of 'keep', 'none', 'skip' or 'raise': %r" % missing)
+
+    if state.get('id_token') is not None:
+        derive = derive_real_id if to_real else derive_fake_id
+        return map(functools.partial(derive, state['id_token']), ids)
+
+    with class_lock(state, bt_class):
+        id_map = state['id_maps'].get(bt_class, _empty_id_map)
+        mapping = dict(id_map.fake_id_for if to_real else id_map.real_id_for)
+
+    return _translate_ids(mapping, ids, missing)
 
 
 def ensure_state_is_init(f):
-    def wrapper(*args, **kwargs):
-        # There's not currently a place to provide global init for the state dict,
-        # each action needs to ensure subitems are initialized.
+    # Actions run for every id rewritten, so the state argument is found by position
+    # rather than by binding every argument.
+    state_position = getargnames(f).index('state')
 
-        named_args = getcallargs(f, *args, **kwargs)
-        state = named_args['state']
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        # SchemaPatcher initializes its state, but actions can be used without one,
+        # so each action needs to ensure subitems are initialized.
 
-        if 'id_maps' not in state:
-            state['id_maps'] = collections.defaultdict(IDMap)
-        if 'last_fake_ids' not in state:
-            state['last_fake_ids'] = {}
+        if state_position < len(args):
+            init_state(args[state_position])
+        else:
+            init_state(getcallargs(f, *args, **kwargs)['state'])
 
         return f(*args, **kwargs)
     return wrapper
@@ -31,7 +238,8 @@ def ensure_state_is_init(f):
 def clear_old_creation_ids(state, call_params, options):
     # Used as a start_hook in appcode entry points (ie, not __init__)
     # to ensure that old state doesn't stick around.
-    state['last_fake_ids'] = {}
+    init_state(state)
+    _call_stack(state)[-1].clear()
 
 
 @ensure_state_is_init
@@ -39,12 +247,18 @@ def convert_to_real_id(params, schema_params, key, resource_id, state, options):
     fake_id = params[key]
     id_maps = state['id_maps']
 
+    if state.get('id_token') is not None:
+        params[key] = derive_real_id(state['id_token'], fake_id)
+        logger.debug("%r --[real_id]--> %r", fake_id, params[key])
+        return
+
     # When replacing, we always default to the value itself.
     # This means that when we don't have the necessary bookkeeping
     # to replace it, everything still proceeds normally.
     real_id = fake_id
     try:
-        real_id = id_maps[resource_id.bt_class].fake_id_for[fake_id]
+        # Avoid inserting into id_maps; this read is done without a lock.
+        real_id = id_maps.get(resource_id.bt_class, _empty_id_map).fake_id_for[fake_id]
     except KeyError:
         # This can happen in two cases:
         #   * The caller made a mistake and didn't create the resource yet.
@@ -62,23 +276,55 @@ def convert_to_real_id(params, schema_params, key, resource_id, state, options):
     logger.debug("%r --[real_id]--> %r", fake_id, params[key])
 
 
+# The validation errors the gateway returns for ids which are already taken.
+duplicate_id_errors = {
+    braintree.Customer: (braintree.ErrorCodes.Customer.IdIsInUse,
+                         'Customer ID has already been taken.'),
+    braintree.CreditCard: (braintree.ErrorCodes.CreditCard.TokenIsInUse, 'Token is in use.'),
+}
+
+
+class KnownDuplicate(Exception):
+    """Raised by delete_and_store to fail a create with an id that's already taken,
+    before it's sent to the gateway. See the 'local_duplicates' option."""
+
+    def __init__(self, bt_class, fake_id, key):
+        super(KnownDuplicate, self).__init__(bt_class, fake_id)
+        self.bt_class = bt_class
+        self.fake_id = fake_id
+        # The keys leading to the id in the call's params, outermost first.
+        self.path = [key]
+
+
 @ensure_state_is_init
 def delete_and_store(params, schema_params, key, resource_id, state, options):
     provided_id = params[key]
     bt_class = resource_id.bt_class
     id_maps = state['id_maps']
 
-    if provided_id in id_maps[bt_class].fake_id_for:
-        # Properly handle duplicate creates of the same id.
-        # We should pass these through, since the gateway will return an error.
-        params[key] = id_maps[bt_class].fake_id_for[provided_id]
-        logger.debug("would have deleted, but %r has been used in a prior creation", provided_id)
-    else:
-        # We need to know which id the client expects the response to be mapped to.
-        # This only works because multiple creations are impossible.
-        state['last_fake_ids'][bt_class] = provided_id
-        del params[key]
-        logger.debug("deleting %r in create call", provided_id)
+    if state.get('id_token') is not None:
+        # The gateway rejects duplicates of derived ids just like the originals.
+        params[key] = derive_real_id(state['id_token'], provided_id)
+        logger.debug("deriving %r in create call", provided_id)
+        return
+
+    with class_lock(state, bt_class):
+        if provided_id in id_maps[bt_class].fake_id_for:
+            # Properly handle duplicate creates of the same id.
+            # We should pass these through, since the gateway will return an error,
+            # unless we've been asked to return that error ourselves.
+            if options.get('local_duplicates') and bt_class in duplicate_id_errors:
+                raise KnownDuplicate(bt_class, provided_id, key)
+
+            params[key] = id_maps[bt_class].fake_id_for[provided_id]
+            logger.debug("would have deleted, but %r has been used in a prior creation",
+                         provided_id)
+        else:
+            # We need to know which id the client expects the response to be mapped to.
+            # It's stored with this call, since other threads may be creating resources too.
+            _call_stack(state)[-1][bt_class] = provided_id
+            del params[key]
+            logger.debug("deleting %r in create call", provided_id)
 
 
 @ensure_state_is_init
@@ -86,27 +332,64 @@ def convert_to_fake_id(params, schema_params, key, resource_id, state, options):
     real_id = params[key]
     id_maps = state['id_maps']
     bt_class = resource_id.bt_class
-    last_fake_ids = state['last_fake_ids']
 
-    if real_id not in id_maps[bt_class].real_id_for:
-        # We need to update our mapping.
-        # This condition also prevents us from updating existing mappings,
-        # which we'd want to change to support id updates.
+    if state.get('id_token') is not None:
+        params[key] = derive_fake_id(state['id_token'], real_id)
+        logger.debug("%r <--[fake_id]-- %r", params[key], real_id)
+        return
+
+    with class_lock(state, bt_class):
+        if real_id not in id_maps[bt_class].real_id_for:
+            # We need to update our mapping.
+            # This condition also prevents us from updating existing mappings,
+            # which we'd want to change to support id updates.
+
+            fake_id = _pop_creation_id(state, bt_class)
+            if fake_id is not None:
+                # An id was provided during creation; include it in our mapping.
+                state['owned_ids'][bt_class][fake_id] = real_id
+            else:
+                # There are two cases here:
+                #    1) No id provided during creation: self-map this key.
+                #       The resource is still owned by the namespace.
+                #    2) We don't have bookkeeping for this id at all: this is an error,
+                #       but the chance of it happening and *also* disrupting normal
+                #       operation is incredibly slim.
+                fake_id = real_id
+                if _is_creating(state, bt_class):
+                    state['owned_ids'][bt_class][fake_id] = real_id
+
+            id_maps[bt_class].fake_id_for[fake_id] = real_id
+            logger.debug('mapping updated: fake_id %r == %r', fake_id, real_id)
+
+        params[key] = id_maps[bt_class].real_id_for[real_id]
 
-        if bt_class in last_fake_ids:
-            # An id was provided during creation; include it in our mapping.
-            fake_id = last_fake_ids.pop(bt_class)
-        else:
-            # There are actually two cases here, but we don't currently distinguish
-            # between them:
-            #    1) No id provided during creation: self-map this key.
-            #    2) We don't have bookkeeping for this id at all: this is an error,
-            #       but the chance of it happening and *also* disrupting normal
-            #       operation is incredibly slim.
-            fake_id = real_id
-
-        id_maps[bt_class].fake_id_for[fake_id] = real_id
-        logger.debug('mapping updated: fake_id %r == %r', fake_id, real_id)
-
-    params[key] = id_maps[bt_class].real_id_for[real_id]
     logger.debug("%r <--[fake_id]-- %r", params[key], real_id)
+
+
+# Notification kinds whose sample subject is built around a transaction id.
+# Kinds are looked up by name since not every braintree version defines all of them.
+_TRANSACTION_WEBHOOK_KINDS = [
+    'TransactionDisbursed',
+    'TransactionRetried',
+    'TransactionReviewed',
+    'TransactionSettled',
+    'TransactionSettlementDeclined',
+]
+
+webhook_subject_classes = dict(
+    (getattr(braintree.WebhookNotification.Kind, name), braintree.Transaction)
+    for name in _TRANSACTION_WEBHOOK_KINDS
+    if hasattr(braintree.WebhookNotification.Kind, name)
+)
+
+
+def convert_webhook_subject_to_real_id(params, schema_params, key, resource_id, state, options):
+    # The class of a sample notification's subject depends on its kind.
+    # Subjects of other kinds aren't namespaced, so they're passed through as-is.
+    bt_class = webhook_subject_classes.get(params.get('kind'))
+    if bt_class is None:
+        return
+
+    convert_to_real_id(params, schema_params, key, ResourceId(bt_class, convert_to_real_id),
+                       state, options)
@@ -0,0 +1,338 @@
+from builtins import object
+import collections
+import copy
+import threading
+
+import braintree
+
+from .actions import convert_to_real_id, lookup_real_id
+from .compat import monotonic
+from .shared import ResourceId, result_attribute
+
+CacheStats = collections.namedtuple('CacheStats', ['hits', 'misses', 'size'])
+
+# Methods which are known not to change anything. Every other method is treated as
+# a write, including those of generated schemas, and drops the resources it refers to.
+READ_METHODS = frozenset([
+    'find',
+    'search',
+    'generate',
+])
+
+# Customers embed the resources they own under these attributes, so a change
+# to one can make its customer stale, and the other way around.
+_owned_attributes = {
+    braintree.CreditCard: 'credit_cards',
+    braintree.Address: 'addresses',
+    braintree.PaymentMethod: 'payment_methods',
+}
+
+# All payment methods share one token space, which is tracked under CreditCard.
+_id_classes = {
+    braintree.PaymentMethod: braintree.CreditCard,
+}
+
+
+def copy_resource(resource):
+    # Resources refer to the gateway that fetched them, which shouldn't be copied.
+    gateway = getattr(resource, 'gateway', None)
+    return copy.deepcopy(resource, {id(gateway): gateway})
+
+
+def freeze(value):
+    """Return a hashable equivalent of nested call params."""
+
+    if isinstance(value, dict):
+        return tuple(sorted((key, freeze(val)) for key, val in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(val) for val in value)
+    return value
+
+
+def _resource_id(resource):
+    return getattr(resource, 'token', None) or getattr(resource, 'id', None)
+
+
+def _ownership(bt_class, real_id, resource, state):
+    """Yield (owned key, owner key) for the customer relationships of a resource."""
+
+    if bt_class is braintree.Customer:
+        for owned_class, attribute in _owned_attributes.items():
+            owned_class = _id_classes.get(owned_class, owned_class)
+            for owned in getattr(resource, attribute, None) or []:
+                owned_id = _resource_id(owned)
+                if owned_id is not None:
+                    yield ((owned_class, lookup_real_id(state, owned_class, owned_id)),
+                           (bt_class, real_id))
+
+    elif bt_class in _owned_attributes:
+        customer_id = getattr(resource, 'customer_id', None)
+        if customer_id is not None:
+            yield ((_id_classes.get(bt_class, bt_class), real_id),
+                   (braintree.Customer, lookup_real_id(state, braintree.Customer, customer_id)))
+
+
+def _referenced_ids(schema_params, params):
+    """Yield (bt_class, real_id) for the fake ids a call's params were rewritten from."""
+
+    for key, val in schema_params.items():
+        if key not in params:
+            continue
+
+        if isinstance(val, dict):
+            for referenced in _referenced_ids(val, params[key]):
+                yield referenced
+        elif isinstance(val, ResourceId) and val.action is convert_to_real_id:
+            yield val.bt_class, params[key]
+
+
+class FindCache(object):
+    """A bounded cache of resources returned by find and create calls.
+
+    Provide an instance as the 'find_cache' option of a Namespace to enable it.
+    Entries are keyed by real id. Any call other than a known read (see READ_METHODS)
+    drops every resource whose id is in its params, including nested ones such as the
+    customer_id of a transaction. Since customers embed their cards, addresses and
+    other payment methods, changing one of those also drops its customer, and changing
+    a customer drops the resources it owns. Callers receive copies, so cached
+    resources can't be changed through them.
+    """
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self._resources = collections.OrderedDict()
+        # Links between cached customers and the resources they own, in both directions.
+        # They're kept for owned resources which aren't cached themselves.
+        self._owner = {}
+        self._owned = collections.defaultdict(set)
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, bt_class, real_id):
+        """Return a copy of the cached resource, or None if there isn't one."""
+
+        key = (bt_class, real_id)
+
+        with self._lock:
+            resource = self._resources.get(key)
+            if resource is None:
+                self._misses += 1
+                return None
+
+            self._hits += 1
+            # Keep recently used entries.
+            del self._resources[key]
+            self._resources[key] = resource
+
+        return copy_resource(resource)
+
+    def put(self, bt_class, real_id, resource, state=None):
+        """Cache a copy of resource.
+
+        :param state: (optional) the namespace's action state, used to find the real ids
+          of the resources it's related to. Without it, no relationships are recorded.
+        """
+
+        links = [] if state is None else list(_ownership(bt_class, real_id, resource, state))
+        resource = copy_resource(resource)
+
+        with self._lock:
+            self._forget((bt_class, real_id))
+            self._resources[(bt_class, real_id)] = resource
+
+            for owned, owner in links:
+                self._owner[owned] = owner
+                self._owned[owner].add(owned)
+
+            while len(self._resources) > self.maxsize:
+                self._forget(next(iter(self._resources)))
+
+    def _forget(self, key):
+        """Drop an entry and its links. The lock must be held."""
+
+        self._resources.pop(key, None)
+
+        owner = self._owner.pop(key, None)
+        if owner is not None and owner in self._owned:
+            self._owned[owner].discard(key)
+
+        for owned in self._owned.pop(key, ()):
+            self._owner.pop(owned, None)
+
+    def invalidate(self, bt_class, real_id):
+        """Drop a resource, along with its owning customer or the resources it owns."""
+
+        key = (bt_class, real_id)
+
+        with self._lock:
+            related = [self._owner.get(key)] + list(self._owned.get(key, ()))
+            self._forget(key)
+
+            for related_key in related:
+                if related_key is not None:
+                    self._forget(related_key)
+
+    def clear(self):
+        with self._lock:
+            self._resources.clear()
+            self._owner.clear()
+            self._owned.clear()
+
+    def stats(self):
+        with self._lock:
+            return CacheStats(self._hits, self._misses, len(self._resources))
+
+    def __len__(self):
+        return len(self._resources)
+
+    def call(self, invoke, call_schema, params, state):
+        """Make a patched call through the cache.
+
+        :param invoke: a callable which makes the call
+        :param params: the call's arguments, after ids have been rewritten
+        """
+
+        bt_class = call_schema.bt_class
+
+        if call_schema.method_name == 'find':
+            keys = [key for key, val in call_schema.params.items()
+                    if isinstance(val, ResourceId) and val.bt_class is bt_class]
+            if len(keys) != 1:
+                return invoke()
+
+            real_id = params[keys[0]]
+            resource = self.get(bt_class, real_id)
+            if resource is None:
+                resource = invoke()
+                self.put(bt_class, real_id, resource, state)
+            return resource
+
+        if call_schema.method_name in READ_METHODS:
+            return invoke()
+
+        # This includes the customer a card or transaction is created for.
+        referenced = list(_referenced_ids(call_schema.params, params))
+
+        for referenced_class, real_id in referenced:
+            self.invalidate(referenced_class, real_id)
+
+        result = invoke()
+
+        # A concurrent find may have refilled entries while the call was in flight.
+        for referenced_class, real_id in referenced:
+            self.invalidate(referenced_class, real_id)
+
+        # PaymentMethod.find isn't cached, so neither are the payment methods created.
+        if (call_schema.method_name == 'create' and bt_class not in _id_classes
+                and getattr(result, 'is_success', False)):
+            resource = getattr(result, result_attribute(bt_class), None)
+            fake_id = _resource_id(resource)
+            if fake_id is not None:
+                self.put(bt_class, lookup_real_id(state, bt_class, fake_id), resource, state)
+
+        return result
+
+
+class ClientTokenCache(object):
+    """A bounded cache of generated client tokens.
+
+    Provide an instance as the 'client_token_cache' option of a Namespace to enable it.
+    ClientToken.generate calls with the same params, after ids have been rewritten,
+    receive the same token until it's ttl seconds old. A customer's tokens are dropped
+    when it's updated or deleted through a patched call.
+    """
+
+    def __init__(self, ttl=300, maxsize=1000):
+        """
+        :param ttl: the number of seconds a token is reused for, by a clock
+          that isn't affected by changes to the system time.
+        :param maxsize: the number of tokens kept; the least recently used are dropped first.
+        """
+
+        self.ttl = ttl
+        self.maxsize = maxsize
+        # key -> (token, expires, customer_id)
+        self._tokens = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key):
+        """Return the unexpired token cached under key, or None if there isn't one."""
+
+        with self._lock:
+            entry = self._tokens.get(key)
+            if entry is None or entry[1] <= monotonic():
+                self._tokens.pop(key, None)
+                self._misses += 1
+                return None
+
+            self._hits += 1
+            del self._tokens[key]
+            self._tokens[key] = entry
+            return entry[0]
+
+    def put(self, key, token, customer_id=None):
+        with self._lock:
+            self._tokens.pop(key, None)
+            self._tokens[key] = (token, monotonic() + self.ttl, customer_id)
+
+            while len(self._tokens) > self.maxsize:
+                self._tokens.popitem(last=False)
+
+    def invalidate(self, customer_id):
+        """Drop the tokens generated for a customer, by its real id."""
+
+        with self._lock:
+            for key in [key for key, entry in self._tokens.items() if entry[2] == customer_id]:
+                del self._tokens[key]
+
+    def clear(self):
+        with self._lock:
+            self._tokens.clear()
+
+    def stats(self):
+        with self._lock:
+            return CacheStats(self._hits, self._misses, len(self._tokens))
+
+    def __len__(self):
+        return len(self._tokens)
+
+    def call(self, invoke, call_schema, params):
+        """Make a patched call through the cache.
+
+        :param invoke: a callable which makes the call
+        :param params: the call's arguments, after ids have been rewritten
+        """
+
+        if call_schema.bt_class is braintree.ClientToken and call_schema.method_name == 'generate':
+            generate_params = params.get('params') or {}
+            try:
+                key = freeze(generate_params)
+                hash(key)
+            except TypeError:
+                return invoke()
+
+            token = self.get(key)
+            if token is None:
+                token = invoke()
+                self.put(key, token, generate_params.get('customer_id'))
+            return token
+
+        if call_schema.method_name not in ('update', 'delete'):
+            return invoke()
+
+        customer_ids = [real_id for bt_class, real_id
+                        in _referenced_ids(call_schema.params, params)
+                        if bt_class is braintree.Customer]
+        for customer_id in customer_ids:
+            self.invalidate(customer_id)
+
+        result = invoke()
+
+        # A concurrent generate may have cached a token while the call was in flight.
+        for customer_id in customer_ids:
+            self.invalidate(customer_id)
+
+        return result
@@ -0,0 +1,88 @@
+from builtins import object
+import collections
+import threading
+
+from .cache import copy_resource, freeze
+
+CoalesceStats = collections.namedtuple('CoalesceStats', ['calls', 'coalesced'])
+
+
+class _Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exception = None
+
+
+class SingleFlight(object):
+    """Coalesces identical concurrent read calls into one gateway request.
+
+    Provide an instance as the 'single_flight' option of a Namespace to enable it.
+    Calls are identical when they're made to the same method with the same
+    arguments, after ids have been rewritten. The first caller makes the request;
+    others arriving before it completes wait and receive a copy of its result,
+    or the exception it raised.
+    """
+
+    def __init__(self, method_names=('find', 'generate')):
+        """
+        :param method_names: the names of the methods which only read from the gateway.
+        """
+
+        self.method_names = frozenset(method_names)
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._calls = 0
+        self._coalesced = 0
+
+    def stats(self):
+        """Return a CoalesceStats. calls counts requests made, and coalesced
+        counts calls which waited on another's request instead."""
+
+        with self._lock:
+            return CoalesceStats(self._calls, self._coalesced)
+
+    def call(self, invoke, method, call_schema, params):
+        """Make a patched call, sharing an in-flight request if there is one.
+
+        :param invoke: a callable which makes the call
+        :param method: the method being patched
+        :param params: the call's arguments, after ids have been rewritten
+        """
+
+        if call_schema.method_name not in self.method_names:
+            return invoke()
+
+        try:
+            key = (method, freeze(params))
+            hash(key)
+        except TypeError:
+            return invoke()
+
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self._calls += 1
+            else:
+                self._coalesced += 1
+
+        if leader:
+            try:
+                flight.result = invoke()
+                return flight.result
+            except Exception as e:
+                flight.exception = e
+                raise
+            finally:
+                with self._lock:
+                    del self._flights[key]
+                flight.done.set()
+
+        flight.done.wait()
+
+        if flight.exception is not None:
+            raise flight.exception
+        return copy_resource(flight.result)
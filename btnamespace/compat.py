@@ -6,6 +6,12 @@ from builtins import zip
 from builtins import next
 import inspect
 import sys
+import time
+import types
+
+
+# time.monotonic was added in python 3.3.
+monotonic = getattr(time, 'monotonic', time.time)
 
 
 # backport of inspect.getcallargs from 2.7
@@ -93,3 +99,17 @@ def getcallargs(func, *positional, **named):
             f_name, 'at least' if defaults else 'exactly', num_required,
             'arguments' if num_required > 1 else 'argument', num_total))
     return arg2value
+
+
+def getargnames(func):
+    """Return the names of func's positional arguments."""
+    if hasattr(inspect, 'getfullargspec'):
+        return inspect.getfullargspec(func).args
+    return inspect.getargspec(func).args
+
+
+def bind(func, obj, objtype=None):
+    """Return a method which calls func with obj as its first argument."""
+    if sys.version_info[0] == 2:
+        return types.MethodType(func, obj, objtype)
+    return types.MethodType(func, obj)
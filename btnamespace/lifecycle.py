@@ -0,0 +1,103 @@
+"""
+Move many namespaced transactions through their lifecycle at once.
+
+Transactions are referred to by their fake ids, so this should be used inside
+an active namespace. Each transaction's steps run in order, but different
+transactions are handled concurrently by a pool of threads.
+"""
+
+from builtins import object
+import collections
+from multiprocessing.pool import ThreadPool
+
+import braintree
+
+LifecycleResult = collections.namedtuple('LifecycleResult', ['transaction_id', 'step', 'result'])
+
+# Common sequences of steps.
+SETTLED = ('submit_for_settlement', 'settle')
+VOIDED = ('void',)
+REFUNDED = ('submit_for_settlement', 'settle', 'refund')
+SETTLEMENT_DECLINED = ('submit_for_settlement', 'settlement_decline')
+
+
+class _Steps(object):
+    """Makes lifecycle calls through a gateway, or the class-level api when there isn't one."""
+
+    def __init__(self, gateway=None):
+        self.gateway = gateway
+
+    def _transactions(self):
+        return self.gateway.transaction if self.gateway is not None else braintree.Transaction
+
+    def _testing(self):
+        gateway = self.gateway if self.gateway is not None else braintree.Configuration.gateway()
+        return gateway.testing
+
+    def submit_for_settlement(self, transaction_id):
+        return self._transactions().submit_for_settlement(transaction_id)
+
+    def void(self, transaction_id):
+        return self._transactions().void(transaction_id)
+
+    def refund(self, transaction_id):
+        return self._transactions().refund(transaction_id)
+
+    # The remaining steps are only available in the sandbox.
+
+    def settle(self, transaction_id):
+        return self._testing().settle_transaction(transaction_id)
+
+    def settlement_confirm(self, transaction_id):
+        return self._testing().settlement_confirm_transaction(transaction_id)
+
+    def settlement_decline(self, transaction_id):
+        return self._testing().settlement_decline_transaction(transaction_id)
+
+    def settlement_pending(self, transaction_id):
+        return self._testing().settlement_pending_transaction(transaction_id)
+
+
+STEPS = ('submit_for_settlement', 'void', 'refund', 'settle', 'settlement_confirm',
+         'settlement_decline', 'settlement_pending')
+
+
+def advance_transactions(transaction_ids, steps=SETTLED, gateway=None, workers=8):
+    """Run steps on each transaction, and return a list of LifecycleResults in the same order.
+
+    A transaction's steps stop at the first unsuccessful result, which is the result
+    returned for it. Exceptions are raised once every transaction has finished.
+    Refunds create transactions, so refunding in parallel needs a namespace
+    created with thread_safe=True.
+
+    :param transaction_ids: fake transaction ids.
+    :param steps: names from STEPS, eg ('submit_for_settlement', 'settle') or SETTLED.
+    :param gateway: (optional) the BraintreeGateway of a gateway-bound namespace.
+    :param workers: the number of transactions handled at once.
+    """
+
+    unknown = [step for step in steps if step not in STEPS]
+    if unknown:
+        raise ValueError("unknown steps %r; choose from %s" % (unknown, ', '.join(STEPS)))
+    if not steps:
+        raise ValueError("at least one step is required")
+
+    calls = _Steps(gateway)
+
+    def advance(transaction_id):
+        for step in steps:
+            result = getattr(calls, step)(transaction_id)
+            if not result.is_success:
+                break
+        return LifecycleResult(transaction_id, step, result)
+
+    transaction_ids = list(transaction_ids)
+    if workers <= 1 or len(transaction_ids) <= 1:
+        return [advance(transaction_id) for transaction_id in transaction_ids]
+
+    pool = ThreadPool(min(workers, len(transaction_ids)))
+    try:
+        return pool.map(advance, transaction_ids)
+    finally:
+        pool.close()
+        pool.join()
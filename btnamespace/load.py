@@ -0,0 +1,395 @@
+"""
+btnamespace-load: drive a mix of namespaced braintree operations and report their latency.
+
+Each operation's latency is split into gateway time (spent in braintree's http strategy)
+and namespace overhead (everything else, including the braintree client itself).
+"""
+
+from __future__ import division, print_function
+
+from builtins import object, range
+import argparse
+import collections
+import math
+import multiprocessing
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+
+import braintree
+
+from .namespace import Namespace
+from . import standin
+
+Sample = collections.namedtuple('Sample', ['operation', 'seconds', 'gateway_seconds', 'error'])
+
+DEFAULT_MIX = {
+    'customer.create': 3,
+    'customer.find': 6,
+    'customer.update': 2,
+    'customer.delete': 1,
+    'credit_card.create': 2,
+    'credit_card.find': 3,
+    'credit_card.update': 1,
+    'credit_card.delete': 1,
+    'transaction.create': 2,
+    'transaction.find': 3,
+    'client_token.generate': 1,
+}
+
+_CARD = {'number': '4111111111111111', 'expiration_date': '05/2030'}
+
+# The error of samples which were skipped, since the resource they needed couldn't be created.
+NO_RESOURCE = 'no resource available'
+
+
+class NoResourceAvailable(Exception):
+    pass
+
+
+class TimedHttpStrategy(object):
+    """Wraps a braintree http strategy to record the time spent in requests per thread."""
+
+    elapsed = threading.local()
+
+    def __init__(self, strategy):
+        self._strategy = strategy
+
+    @classmethod
+    def factory(cls, http_strategy=None):
+        def create(config, environment):
+            strategy = http_strategy(config, environment) if http_strategy else config.http()
+            return cls(strategy)
+        return create
+
+    @classmethod
+    def take_elapsed(cls):
+        seconds = getattr(cls.elapsed, 'seconds', 0.0)
+        cls.elapsed.seconds = 0.0
+        return seconds
+
+    def http_do(self, *args):
+        start = time.time()
+        try:
+            return self._strategy.http_do(*args)
+        finally:
+            self.elapsed.seconds = (getattr(self.elapsed, 'seconds', 0.0)
+                                    + time.time() - start)
+
+    def __getattr__(self, name):
+        return getattr(self._strategy, name)
+
+
+class Workload(object):
+    """Runs randomly chosen operations on resources it created."""
+
+    def __init__(self, mix, rng):
+        self.operations = sorted(mix)
+        self.weights = [mix[operation] for operation in self.operations]
+        self.rng = rng
+
+        self.customer_ids = []
+        self.credit_card_tokens = []
+        self.transaction_ids = []
+
+    def _new_id(self):
+        return 'load_' + uuid.uuid4().hex[:12]
+
+    def _pick(self, ids, create):
+        if not ids:
+            create()
+        if not ids:
+            raise NoResourceAvailable()
+        return self.rng.choice(ids)
+
+    def run_one(self):
+        """Run one operation; return a Sample."""
+
+        operation = self._weighted_choice()
+
+        TimedHttpStrategy.take_elapsed()
+        start = time.time()
+        try:
+            ok = getattr(self, operation.replace('.', '_'))() is not False
+            error = None if ok else 'unsuccessful result'
+        except NoResourceAvailable:
+            error = NO_RESOURCE
+        except Exception as e:
+            error = type(e).__name__
+
+        seconds = time.time() - start
+        return Sample(operation, seconds, TimedHttpStrategy.take_elapsed(), error)
+
+    def _weighted_choice(self):
+        point = self.rng.uniform(0, sum(self.weights))
+        for operation, weight in zip(self.operations, self.weights):
+            point -= weight
+            if point <= 0:
+                return operation
+        return self.operations[-1]
+
+    def customer_create(self):
+        customer_id = self._new_id()
+        result = braintree.Customer.create({'id': customer_id, 'first_name': 'Load'})
+        if result.is_success:
+            self.customer_ids.append(customer_id)
+        return result.is_success
+
+    def customer_find(self):
+        braintree.Customer.find(self._pick(self.customer_ids, self.customer_create))
+
+    def customer_update(self):
+        customer_id = self._pick(self.customer_ids, self.customer_create)
+        return braintree.Customer.update(customer_id, {'first_name': 'Updated'}).is_success
+
+    def customer_delete(self):
+        customer_id = self._pick(self.customer_ids, self.customer_create)
+        self.customer_ids.remove(customer_id)
+        braintree.Customer.delete(customer_id)
+
+        # The customer's cards were deleted with it.
+        self.credit_card_tokens = [(token, owner) for token, owner in self.credit_card_tokens
+                                   if owner != customer_id]
+
+    def credit_card_create(self):
+        customer_id = self._pick(self.customer_ids, self.customer_create)
+        token = self._new_id()
+
+        params = dict(_CARD, customer_id=customer_id, token=token)
+        result = braintree.CreditCard.create(params)
+        if result.is_success:
+            self.credit_card_tokens.append((token, customer_id))
+        return result.is_success
+
+    def credit_card_find(self):
+        token, _ = self._pick(self.credit_card_tokens, self.credit_card_create)
+        braintree.CreditCard.find(token)
+
+    def credit_card_update(self):
+        token, _ = self._pick(self.credit_card_tokens, self.credit_card_create)
+        return braintree.CreditCard.update(token, {'expiration_date': '06/2030'}).is_success
+
+    def credit_card_delete(self):
+        token, owner = self._pick(self.credit_card_tokens, self.credit_card_create)
+        self.credit_card_tokens.remove((token, owner))
+        braintree.CreditCard.delete(token)
+
+    def transaction_create(self):
+        token, _ = self._pick(self.credit_card_tokens, self.credit_card_create)
+        result = braintree.Transaction.create({
+            'type': 'sale',
+            'amount': '10.00',
+            'payment_method_token': token,
+        })
+        if result.is_success:
+            self.transaction_ids.append(result.transaction.id)
+        return result.is_success
+
+    def transaction_find(self):
+        braintree.Transaction.find(self._pick(self.transaction_ids, self.transaction_create))
+
+    def client_token_generate(self):
+        customer_id = self._pick(self.customer_ids, self.customer_create)
+        braintree.ClientToken.generate({'customer_id': customer_id})
+
+
+def configure(args, seed=None):
+    """Configure the braintree library for args.target ('standin' or 'sandbox')."""
+
+    if args.target == 'standin':
+        environment = braintree.Environment.Development
+        credentials = ('merchant_id', 'public_key', 'private_key')
+        http_strategy = standin.StandinGateway(
+            latency=args.latency, jitter=args.jitter, timeout_rate=args.timeout_rate,
+            error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+            max_rate=args.max_rate, seed=seed).http_strategy()
+    else:
+        environment = braintree.Environment.Sandbox
+        credentials = (os.environ['BT_MERCHANT_ID'], os.environ['BT_PUBLIC_KEY'],
+                       os.environ['BT_PRIVATE_KEY'])
+        http_strategy = None
+
+    braintree.Configuration.configure(
+        environment, *credentials,
+        http_strategy=TimedHttpStrategy.factory(http_strategy),
+        timeout=args.timeout)
+
+
+def _run_worker(mix, deadline, start_at, seed, samples):
+    time.sleep(max(0.0, start_at - time.time()))
+
+    workload = Workload(mix, random.Random(seed))
+    while time.time() < deadline:
+        samples.append(workload.run_one())
+
+
+def _run_threads(args, mix, first_worker, workers, namespace_kwargs):
+    samples = []
+    begin = time.time()
+    deadline = begin + args.ramp_up + args.duration
+
+    with Namespace(**namespace_kwargs):
+        threads = [
+            threading.Thread(target=_run_worker, args=(
+                mix, deadline, begin + args.ramp_up * i / args.workers, args.seed + i, samples))
+            for i in range(first_worker, first_worker + workers)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    return samples
+
+
+def _process_main(packed):
+    args, mix, worker = packed
+    configure(args, args.seed + worker)
+    return _run_threads(args, mix, worker, 1, {'engine': args.engine})
+
+
+def run(args, mix):
+    """Run the workload described by args; return a list of Samples."""
+
+    if args.mode == 'process':
+        pool = multiprocessing.Pool(args.workers)
+        try:
+            results = pool.map(_process_main, [(args, mix, i) for i in range(args.workers)])
+        finally:
+            pool.close()
+            pool.join()
+        return [sample for samples in results for sample in samples]
+
+    configure(args, args.seed)
+    return _run_threads(args, mix, 0, args.workers, {'thread_safe': True, 'engine': args.engine})
+
+
+def percentile(values, fraction):
+    """Return the nearest-rank percentile of sorted values."""
+
+    if not values:
+        return 0.0
+    rank = int(math.ceil(fraction * len(values)))
+    return values[max(0, min(len(values), rank) - 1)]
+
+
+def report(samples, elapsed, out=sys.stdout):
+    def line(name, values):
+        values = sorted(values)
+        print("  %-10s p50 %8.2fms  p95 %8.2fms  p99 %8.2fms" % (
+            name, percentile(values, .5) * 1000, percentile(values, .95) * 1000,
+            percentile(values, .99) * 1000), file=out)
+
+    skipped = len([sample for sample in samples if sample.error == NO_RESOURCE])
+    samples = [sample for sample in samples if sample.error != NO_RESOURCE]
+
+    by_operation = collections.defaultdict(list)
+    for sample in samples:
+        by_operation[sample.operation].append(sample)
+
+    errors = collections.Counter(sample.error for sample in samples if sample.error)
+
+    print("%s operations in %.1fs: %.1f ops/s, %s failed" % (
+        len(samples), elapsed, len(samples) / elapsed if elapsed else 0,
+        sum(errors.values())), file=out)
+    if skipped:
+        print("  %s skipped: %s" % (skipped, NO_RESOURCE), file=out)
+    for error, count in errors.most_common():
+        print("  %-28s %s" % (error, count), file=out)
+
+    for operation in [None] + sorted(by_operation):
+        operation_samples = samples if operation is None else by_operation[operation]
+        print("%s (%s)" % (operation or 'all operations', len(operation_samples)), file=out)
+        line('total', [s.seconds for s in operation_samples])
+        line('gateway', [s.gateway_seconds for s in operation_samples])
+        line('namespace', [s.seconds - s.gateway_seconds for s in operation_samples])
+
+
+def parse_mix(spec):
+    """Parse a mix like 'customer.create=2,customer.find=5'."""
+
+    mix = {}
+    for item in spec.split(','):
+        operation, _, weight = item.partition('=')
+        if operation not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError("unknown operation %r; choose from %s"
+                                             % (operation, ', '.join(sorted(DEFAULT_MIX))))
+        mix[operation] = float(weight or 1)
+    return mix
+
+
+_distributions = {
+    'constant': standin.constant,
+    'uniform': standin.uniform,
+    'exponential': standin.exponential,
+    'lognormal': standin.lognormal,
+}
+
+
+def parse_latency(spec):
+    """Parse a latency like '0.1' or 'lognormal:0.1,0.5' into a stand-in latency distribution."""
+
+    name, _, values = spec.rpartition(':')
+    name = name or 'constant'
+    if name not in _distributions:
+        raise argparse.ArgumentTypeError(
+            "unknown distribution %r; choose from %s" % (name, ', '.join(sorted(_distributions))))
+
+    try:
+        return _distributions[name](*[float(value) for value in values.split(',')])
+    except (TypeError, ValueError):
+        raise argparse.ArgumentTypeError("invalid parameters for %s: %r" % (name, values))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='btnamespace-load',
+        description="Run a mix of namespaced braintree operations and report their latency.")
+    parser.add_argument('--target', choices=['standin', 'sandbox'], default='standin',
+                        help="the local stand-in gateway (default), or the sandbox configured"
+                             " by BT_MERCHANT_ID, BT_PUBLIC_KEY and BT_PRIVATE_KEY.")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--mode', choices=['thread', 'process'], default='thread',
+                        help="threads share one namespace; processes each use their own.")
+    parser.add_argument('--duration', type=float, default=10,
+                        help="seconds to run once every worker has started.")
+    parser.add_argument('--ramp-up', type=float, default=0,
+                        help="seconds over which to start workers.")
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help="weighted operations, eg 'customer.create=1,customer.find=4'."
+                             " Defaults to every supported operation.")
+    parser.add_argument('--engine', choices=['init', 'response'], default='init',
+                        help="how the namespace rewrites ids in responses; see Namespace.")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeout', type=float, default=60,
+                        help="seconds the braintree client waits for a response.")
+
+    conditions = parser.add_argument_group(
+        'stand-in conditions', "Model gateway behavior when the target is the stand-in.")
+    conditions.add_argument('--latency', type=parse_latency,
+                            help="seconds per request, or a distribution: eg 'uniform:0.05,0.2',"
+                                 " 'exponential:0.1' or 'lognormal:0.1,0.5' (median, sigma).")
+    conditions.add_argument('--jitter', type=float, default=0.0,
+                            help="vary each request's latency by up to this many seconds.")
+    conditions.add_argument('--timeout-rate', type=float, default=0.0,
+                            help="fraction of requests which never respond.")
+    conditions.add_argument('--error-rate', type=float, default=0.0,
+                            help="fraction of requests which fail with a server error.")
+    conditions.add_argument('--throttle-rate', type=float, default=0.0,
+                            help="fraction of requests rejected as too many requests.")
+    conditions.add_argument('--max-rate', type=float,
+                            help="requests per second beyond which requests are throttled.")
+    args = parser.parse_args(argv)
+
+    start = time.time()
+    samples = run(args, args.mix)
+    report(samples, time.time() - start)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,20 +1,104 @@
 from builtins import object
+import collections
+import contextlib
+import re
+
 import braintree
+from braintree.util.xml_util import XmlUtil
 from mock import patch
 
-from .patch import SchemaPatcher
+from .actions import class_lock, creating_classes, translate_ids
+from .patch import SchemaPatcher, SharedPatcher
 from .schemas import schemas
 from .shared import UnsupportedSearchNode
+from .transport import ConnectionPool, PooledHttp
+
+
+search_patch_nodes = {
+    braintree.CustomerSearch: [
+        'id', 'payment_method_token', 'payment_method_token_with_duplicates'],
+
+    braintree.TransactionSearch: [
+        'id', 'payment_method_token', 'customer_id'],
+}
+
+# The resource class each search is for.
+search_classes = {
+    braintree.CustomerSearch: braintree.Customer,
+    braintree.TransactionSearch: braintree.Transaction,
+}
+
+
+def _selection(patch_only):
+    """Return (selected, classes): a set of the classes and (class, method_name) pairs
+    whose schemas are patched, and a set of every class involved."""
+
+    selected = set()
+    classes = set()
+
+    for item in patch_only:
+        if isinstance(item, tuple) and len(item) == 2:
+            bt_class, _ = item
+            selected.update([item, (bt_class, '__init__')])
+        elif isinstance(item, type):
+            bt_class = item
+            selected.add(bt_class)
+        else:
+            raise ValueError("patch_only items must be classes or (class, method_name) pairs: %r"
+                             % (item,))
+
+        classes.add(bt_class)
+
+    return selected, classes
 
 
 class Namespace(object):
     """A Namespace is a context manager which guarantees that state on Braintree
     will not be shared."""
 
-    def __init__(self, custom_schemas=None, options=None):
+    def __init__(self, custom_schemas=None, options=None, gateway=None, pool_size=None,
+                 thread_safe=False, id_token=None, patch_only=None, engine='init'):
         """
         :param custom_schemas: (optional) a list of CallSchemas to guide patching.
           If they're not provided, those defined in actions.schemas will be used.
+          There's one schema per method; a later schema for the same method replaces
+          an earlier one. Schemas can also be changed later with register_schema
+          and unregister_schema.
+        :param gateway: (optional) a braintree.BraintreeGateway to bind this namespace to.
+          By default, the class-level braintree api (eg braintree.Customer.create) is patched.
+          When a gateway is provided, only calls made through it (eg gateway.customer.create)
+          are namespaced instead. Namespaces bound to different gateways have independent
+          state and may be active at the same time, but should not be mixed with an
+          unbound namespace.
+        :param pool_size: (optional) when provided, braintree requests made while the
+          namespace is active are sent over a pool of keep-alive connections of this size.
+          The pool is available as connection_pool; see ConnectionPool.stats.
+          Its connections are closed when the namespace exits.
+        :param thread_safe: (optional) if True, the namespace may be used by several threads
+          at once. Updates to its id maps are guarded by one lock per braintree class,
+          and lookups don't lock at all.
+        :param id_token: (optional) a short string of letters, digits and dashes.
+          When provided, real ids are derived from it instead of being stored:
+          a provided id 'x' is sent to the gateway as '<id_token>_x', and ids the gateway
+          generates are given fake ids starting with '=', which are sent without the
+          token (so '=' + real_id refers to any resource). Since ids are translated
+          by computation alone, any process using the same id_token shares the namespace,
+          and no state grows as resources are created. Provided ids must then be short
+          enough to fit braintree's length limit along with the token, and created_ids
+          is always empty.
+        :param patch_only: (optional) a list of braintree classes and (class, method_name)
+          pairs. When provided, only those methods, every method of those classes, and the
+          search nodes of those classes are patched, so entering and exiting cost less.
+          The __init__ of each class named is always included, as is the __init__ of any
+          class a selected method can create, such as the credit card created along with
+          a customer. Other resources nested in responses (eg the cards of a customer
+          that's found) are only rewritten when their class is named too.
+        :param engine: (optional) how ids in responses are rewritten. By default ('init'),
+          each resource's __init__ is patched, and ids are translated as each resource is built.
+          With 'response', braintree's XML parser is patched instead, and the ids of every
+          resource in a response are translated in one pass as it's parsed. This costs much
+          less for large responses, but resources built from anything other than XML
+          (eg constructed directly) aren't rewritten. It can't be used with a gateway.
         :param options (optional) a dictionary of configuration passed through to
           actions. The same instance is passed to options; it can be mutated
           at runtime to affect the next action run.
@@ -27,6 +111,24 @@ class Namespace(object):
                 the request is sent.
                 By default this exception is braintree.exceptions.NotFoundError,
                 but can be overridden with strict_missing_exception.
+              * 'trace': a btnamespace.RewriteTrace. When provided, every id rewrite
+                is recorded in its bounded buffer. Omit it to disable tracing.
+              * 'find_cache': a btnamespace.FindCache. When provided, find calls
+                for resources already fetched or created in the namespace are served
+                from it. Omit it to disable caching.
+              * 'single_flight': a btnamespace.SingleFlight. When provided, identical
+                concurrent find and ClientToken.generate calls share one gateway request.
+              * 'rate_limit': a btnamespace.RateLimiter. When provided, gateway requests
+                made through patched methods wait for a token from its bucket.
+                Calls served by 'find_cache' or 'single_flight' don't take a token.
+              * 'client_token_cache': a btnamespace.ClientTokenCache. When provided,
+                ClientToken.generate calls with the same params reuse a recently
+                generated token.
+              * 'local_duplicates': if True, creating a customer or credit card with
+                an id that was already created in the namespace returns the gateway's
+                ErrorResult without sending a request. By default the request is sent,
+                and the gateway rejects it. Derived ids aren't tracked, so duplicates
+                of them are always sent.
         """
 
         if custom_schemas is None:
@@ -35,34 +137,231 @@ class Namespace(object):
         if options is None:
             options = {}
 
-        self.schemas = custom_schemas
         self.options = options
-        self.schema_patcher = SchemaPatcher(self.options)
-        self._patchers = self.schema_patcher.create_patchers(self.schemas)
+        self.gateway = gateway
+        if id_token is not None and not re.match(r'^[A-Za-z0-9-]+$', id_token):
+            raise ValueError("id_token may only contain letters, digits and dashes: %r"
+                             % id_token)
+
+        if engine not in ('init', 'response'):
+            raise ValueError("engine must be 'init' or 'response': %r" % engine)
+        if engine == 'response' and gateway is not None:
+            # The parser is shared by every gateway, and doesn't know which one is calling it.
+            raise ValueError("the 'response' engine can't be used with a gateway")
+
+        self.id_token = id_token
+        self.engine = engine
+        self.schema_patcher = SchemaPatcher(self.options, gateway, thread_safe, id_token,
+                                            rewrite_responses=engine == 'response')
+        self._active = False
+
+        selected = classes = None
+        if patch_only is not None:
+            selected, classes = _selection(patch_only)
+
+        # (bt_class, method_name) -> CallSchema, and the patchers created from it.
+        self._schemas = collections.OrderedDict()
+        self._schema_patchers = {}
+
+        def is_selected(call_schema):
+            key = (call_schema.bt_class, call_schema.method_name)
+            return selected is None or call_schema.bt_class in selected or key in selected
+
+        if selected is not None:
+            # Creation ids a selected schema removes must be mapped back to when the
+            # created resources are built, including nested ones (eg a customer's card).
+            for call_schema in [s for s in custom_schemas if is_selected(s)]:
+                for bt_class in creating_classes(call_schema.params):
+                    selected.add((bt_class, '__init__'))
 
-        search_patch_nodes = {
-            braintree.CustomerSearch: [
-                'id', 'payment_method_token', 'payment_method_token_with_duplicates'],
+        for call_schema in custom_schemas:
+            if is_selected(call_schema):
+                self._schemas[(call_schema.bt_class, call_schema.method_name)] = call_schema
+        for key, call_schema in self._schemas.items():
+            self._schema_patchers[key] = self.schema_patcher.create_schema_patchers(call_schema)
 
-            braintree.TransactionSearch: [
-                'id', 'payment_method_token', 'customer_id'],
-        }
+        # Patchers which aren't created from schemas.
+        self._patchers = []
+
+        # Search nodes are class attributes, so they're patched for every gateway.
+        patch_node = patch.object if gateway is None else SharedPatcher
 
         for search_cls, node_names in list(search_patch_nodes.items()):
+            if classes is not None and search_classes[search_cls] not in classes:
+                continue
+
             for node_name in node_names:
                 self._patchers.append(
-                    patch.object(search_cls, node_name, UnsupportedSearchNode())
+                    patch_node(search_cls, node_name, UnsupportedSearchNode())
                 )
 
+        if self.schema_patcher.response_rewriter is not None:
+            self._patchers.append(patch.object(
+                XmlUtil, 'dict_from_xml', self.schema_patcher.response_rewriter))
+
+        self.connection_pool = None
+        if pool_size is not None:
+            self.connection_pool = ConnectionPool(pool_size)
+
+            if gateway is None:
+                self._patchers.append(patch.object(
+                    braintree.Configuration, 'default_http_strategy',
+                    self.connection_pool.http_strategy(), create=True))
+            else:
+                self._patchers.append(patch.object(
+                    gateway.config, '_http_strategy',
+                    PooledHttp(gateway.config, gateway.config.environment, self.connection_pool)))
+
     def __enter__(self):
         """Globally patch the braintree library to create a new namespace.
 
-        Only one namespace may be active at any time.
+        Only one unbound namespace may be active at any time.
         Results from entering more than once are undefined.
         """
+        for key in self._schemas:
+            for patcher in self._schema_patchers[key]:
+                patcher.start()
+
         for patcher in self._patchers:
             patcher.start()
 
+        self._active = True
+
     def __exit__(self, *exc):
+        self._active = False
+
+        for key in self._schemas:
+            for patcher in self._schema_patchers[key]:
+                patcher.stop()
+
         for patcher in self._patchers:
             patcher.stop()
+
+        if self.connection_pool is not None:
+            self.connection_pool.close()
+
+    @property
+    def schemas(self):
+        """The list of registered CallSchemas.
+
+        This is a copy; changing it in place has no effect. Assigning a list
+        replaces every registered schema, repatching an active namespace.
+        """
+        return list(self._schemas.values())
+
+    @schemas.setter
+    def schemas(self, call_schemas):
+        for key in list(self._schemas):
+            self._remove_schema(key)
+
+        for call_schema in call_schemas:
+            self.register_schema(call_schema)
+
+    def get_schema(self, bt_class, method_name):
+        """Return the CallSchema registered for a method, or None."""
+        return self._schemas.get((bt_class, method_name))
+
+    def register_schema(self, call_schema):
+        """Add call_schema, replacing any schema registered for the same method.
+
+        When the namespace is active, only that method is repatched.
+        """
+
+        key = (call_schema.bt_class, call_schema.method_name)
+        self._remove_schema(key)
+
+        self._schemas[key] = call_schema
+        self._schema_patchers[key] = self.schema_patcher.create_schema_patchers(call_schema)
+
+        if self._active:
+            for patcher in self._schema_patchers[key]:
+                patcher.start()
+
+    def unregister_schema(self, bt_class, method_name):
+        """Remove and return the CallSchema registered for a method.
+
+        When the namespace is active, only that method is unpatched.
+        Raises KeyError if no schema is registered for it.
+        """
+
+        key = (bt_class, method_name)
+        if key not in self._schemas:
+            raise KeyError(key)
+
+        return self._remove_schema(key)
+
+    def _remove_schema(self, key):
+        call_schema = self._schemas.pop(key, None)
+        patchers = self._schema_patchers.pop(key, [])
+
+        if self._active:
+            for patcher in patchers:
+                patcher.stop()
+
+        return call_schema
+
+    @contextlib.contextmanager
+    def paused(self):
+        """Return a context manager in which calls made by this thread aren't namespaced.
+
+        Patches stay installed, so pausing is nearly free. Advanced searches on ids
+        are still disallowed while paused.
+        """
+
+        calls = self.schema_patcher._action_state['calls']
+        was_paused = getattr(calls, 'paused', False)
+        calls.paused = True
+
+        try:
+            yield
+        finally:
+            calls.paused = was_paused
+
+    def reset(self):
+        """Forget every id mapped in this namespace, as if it had just been created.
+
+        This is much cheaper than entering a new namespace, since patches stay in place.
+        It has no effect on derived ids, which depend only on the id_token.
+        """
+        self.schema_patcher.reset_state()
+
+        for cache_option in ('find_cache', 'client_token_cache'):
+            cache = self.options.get(cache_option)
+            if cache is not None:
+                cache.clear()
+
+    def to_real_ids(self, bt_class, fake_ids, missing='keep'):
+        """Return an iterator over the real ids of fake_ids, in order.
+
+        :param fake_ids: an iterable of id strings. It's consumed lazily, so large
+          streams can be translated without holding them in memory.
+        :param missing: how to treat ids this namespace hasn't mapped:
+          'keep' passes them through unchanged, as patched calls do;
+          'none' replaces them with None; 'skip' omits them;
+          and 'raise' raises KeyError.
+        """
+        return translate_ids(self.schema_patcher._action_state, bt_class, fake_ids,
+                             True, missing)
+
+    def to_fake_ids(self, bt_class, real_ids, missing='keep'):
+        """Return an iterator over the fake ids of real_ids, in order. See to_real_ids."""
+        return translate_ids(self.schema_patcher._action_state, bt_class, real_ids,
+                             False, missing)
+
+    def _owned_ids(self, bt_class):
+        return self.schema_patcher._action_state['owned_ids'].get(bt_class, {})
+
+    def created_ids(self, bt_class):
+        """Return a list of (fake_id, real_id) pairs for the resources of bt_class
+        that were created in this namespace, oldest first.
+
+        Resources created without a provided id are included with the id the gateway
+        gave them, which is both their fake and real id. Resources which were only
+        found, or which were created while the namespace was paused, aren't.
+        """
+        with class_lock(self.schema_patcher._action_state, bt_class):
+            return list(self._owned_ids(bt_class).items())
+
+    def owns(self, bt_class, fake_id):
+        """Return True if the resource with this fake id was created in this namespace."""
+        return fake_id in self._owned_ids(bt_class)
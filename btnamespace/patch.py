@@ -3,14 +3,65 @@ from builtins import object
 import copy
 import functools
 import logging
+import threading
 
+import braintree
+from braintree.util.xml_util import XmlUtil
 from mock import patch
 
-from .compat import getcallargs
+from .actions import (
+    KnownDuplicate,
+    begin_call,
+    creating_classes,
+    duplicate_id_errors,
+    end_call,
+    init_state,
+    mark_creating,
+)
+from .compat import bind, getargnames, getcallargs
+from .rewrite import ResponseRewriter, ResponseSchemaPatcher
 from .schemas import ResourceId
+from .shared import compile_schema_params, result_attribute
 
 logger = logging.getLogger(__name__)
 
+# The attribute of a BraintreeGateway that provides each class's static methods.
+# Names are used since not every braintree version defines all of these classes.
+_gateway_attribute_names = {
+    'Address': 'address',
+    'ClientToken': 'client_token',
+    'CreditCard': 'credit_card',
+    'CreditCardVerification': 'verification',
+    'Customer': 'customer',
+    'Dispute': 'dispute',
+    'PayPalAccount': 'paypal_account',
+    'PaymentMethod': 'payment_method',
+    'PaymentMethodNonce': 'payment_method_nonce',
+    'SepaDirectDebitAccount': 'sepa_direct_debit_account',
+    'Subscription': 'subscription',
+    'TestingGateway': 'testing',
+    'Transaction': 'transaction',
+    'TransactionLineItem': 'transaction_line_item',
+    'UsBankAccount': 'us_bank_account',
+    'UsBankAccountVerification': 'us_bank_account_verification',
+    'WebhookNotification': 'webhook_notification',
+    'WebhookTesting': 'webhook_testing',
+}
+
+gateway_attributes = dict(
+    (getattr(braintree, class_name), attribute)
+    for class_name, attribute in _gateway_attribute_names.items()
+    if hasattr(braintree, class_name)
+)
+
+
+def _unpatched(method):
+    """Return the original of a method patched by another active namespace."""
+
+    while isinstance(getattr(method, '__self__', None), PatchedMethod):
+        method = method.__self__.method
+    return method
+
 
 class PatchedMethod(object):
     """Instances of this callable replace braintree methods."""
@@ -29,8 +80,26 @@ class PatchedMethod(object):
         self.options = options
 
     def __call__(self, *args, **kwargs):
+        if getattr(self.state['calls'], 'paused', False):
+            return self.method(*args, **kwargs)
+
+        if self.call_schema.method_name == '__init__':
+            # Resources are built while handling the call that fetched them.
+            return self._call(args, kwargs)
+
+        begin_call(self.state)
+        try:
+            return self._call(args, kwargs)
+        finally:
+            end_call(self.state)
+
+    def _call(self, args, kwargs):
         named_args = getcallargs(self.method, *args, **kwargs)
 
+        if getattr(self.method, '__self__', None) is not None:
+            # Bound methods (ie, those of a BraintreeGateway) already carry their receiver.
+            named_args.pop('self', None)
+
         # Avoid mutating caller objects.
         # We can't just do deepcopy(named_args), because then we'll make copies of
         # self and gateway.
@@ -41,15 +110,63 @@ class PatchedMethod(object):
         if self.call_schema.start_hook is not None:
             self.call_schema.start_hook(self.state, named_args_copy, self.options)
 
-        self._apply_param_actions(named_args_copy, self.call_schema.params)
+        creating = creating_classes(self.call_schema.params, named_args_copy)
+        if creating:
+            mark_creating(self.state, creating)
+
+        try:
+            self._apply_param_actions(named_args_copy, self.call_schema.params)
+        except KnownDuplicate as e:
+            return self._duplicate_result(e)
+
+        if self.call_schema.method_name == '__init__':
+            return self._invoke(args, named_args_copy)
+
+        invoke = functools.partial(self._invoke, args, named_args_copy)
+
+        rate_limit = self.options.get('rate_limit')
+        if rate_limit is not None:
+            invoke = functools.partial(rate_limit.call, invoke)
 
-        if (('self' in named_args_copy
-             and args[0] is named_args_copy['self'])):
+        single_flight = self.options.get('single_flight')
+        if single_flight is not None:
+            invoke = functools.partial(single_flight.call, invoke, self.method,
+                                       self.call_schema, dict(named_args_copy))
+
+        client_token_cache = self.options.get('client_token_cache')
+        if client_token_cache is not None:
+            invoke = functools.partial(client_token_cache.call, invoke,
+                                       self.call_schema, named_args_copy)
+
+        find_cache = self.options.get('find_cache')
+        if find_cache is not None:
+            return find_cache.call(invoke, self.call_schema, named_args_copy, self.state)
+
+        return invoke()
+
+    def _invoke(self, args, named_args):
+        if (('self' in named_args
+             and args[0] is named_args['self'])):
             # Receivers need to be passed positionally, apparently.
-            receiver = named_args_copy.pop('self')
-            return self.method(receiver, **named_args_copy)
+            receiver = named_args.pop('self')
+            return self.method(receiver, **named_args)
+
+        return self.method(**named_args)
+
+    def _duplicate_result(self, duplicate):
+        """Return the ErrorResult the gateway would for a create with a taken id."""
 
-        return self.method(**named_args_copy)
+        code, message = duplicate_id_errors[duplicate.bt_class]
+
+        # Errors are nested like the params, under the name of the class being called.
+        # The outermost key is the argument holding the params, eg 'params'.
+        keys = [result_attribute(self.call_schema.bt_class)] + duplicate.path[1:-1]
+        errors = {'errors': [{'code': code, 'attribute': duplicate.path[-1], 'message': message}]}
+        for key in reversed(keys):
+            errors = {'errors': [], key: errors}
+
+        logger.debug("returning a duplicate error for %r without a request", duplicate.fake_id)
+        return braintree.ErrorResult(None, {'errors': errors, 'message': message, 'params': {}})
 
     def _apply_param_actions(self, params, schema_params):
         """Traverse a schema and perform the updates it describes to params."""
@@ -59,43 +176,287 @@ class PatchedMethod(object):
                 continue
 
             if isinstance(val, dict):
-                self._apply_param_actions(params[key], schema_params[key])
+                try:
+                    self._apply_param_actions(params[key], schema_params[key])
+                except KnownDuplicate as e:
+                    e.path.insert(0, key)
+                    raise
             elif isinstance(val, ResourceId):
-                resource_id = val
-
-                # Callers can provide ints as ids.
-                # We normalize them to strings so that actions don't get confused.
-                params[key] = str(params[key])
-
-                resource_id.action(params, schema_params, key,
-                                   resource_id, self.state, self.options)
+                self._apply_action(params, schema_params, key, val)
             else:
                 logger.error("Invalid value in schema params: %r. schema_params: %r and params: %r",
                              val, schema_params, params)
 
+    def _apply_action(self, params, schema_params, key, resource_id):
+        # Callers can provide ints as ids.
+        # We normalize them to strings so that actions don't get confused.
+        provided_id = params[key] = str(params[key])
+
+        resource_id.action(params, schema_params, key,
+                           resource_id, self.state, self.options)
+
+        trace = self.options.get('trace')
+        if trace is not None:
+            trace.record(provided_id, params.get(key), resource_id, self.call_schema)
+
     def __get__(self, obj, objtype):
         if obj is None:
             # This is a staticmethod; don't provide the receiver.
             return self.__call__
 
-        # This is an instance method; freeze the receiver onto the call.
-        return functools.partial(self.__call__, obj)
+        # This is an instance method; bind the receiver to the call.
+        return bind(self, obj, objtype)
+
+
+class PatchedInit(PatchedMethod):
+    """A PatchedMethod specialized for __init__, which runs for every resource built.
+
+    Arguments are located by position rather than bound with getcallargs,
+    and rather than deep-copying them, only the dicts which contain rewritten ids are copied.
+    """
+
+    def __init__(self, method, state, call_schema, options):
+        super(PatchedInit, self).__init__(method, state, call_schema, options)
+
+        # The receiver is passed separately, so positions start after it.
+        arg_names = getargnames(_unpatched(method))[1:]
+        self._args = [(key, arg_names.index(key) if key in arg_names else None,
+                       compile_schema_params(call_schema.params[key]))
+                      for key in call_schema.params]
+
+    def __call__(self, receiver, *args, **kwargs):
+        if getattr(self.state['calls'], 'paused', False):
+            return self.method(receiver, *args, **kwargs)
+
+        for key, position, compiled in self._args:
+            if position is not None and position < len(args):
+                args = (args[:position]
+                        + (self._rewritten(args[position], compiled),)
+                        + args[position + 1:])
+            elif key in kwargs:
+                kwargs[key] = self._rewritten(kwargs[key], compiled)
+
+        return self.method(receiver, *args, **kwargs)
+
+    def _rewritten(self, params, compiled):
+        """Return a copy of params with the updates its compiled schema params describe."""
+
+        if not isinstance(params, dict):
+            return params
+
+        schema_params, resource_ids, nested = compiled
+        params = dict(params)
+
+        for key, nested_compiled in nested:
+            if key in params:
+                params[key] = self._rewritten(params[key], nested_compiled)
+
+        for key, resource_id in resource_ids:
+            if key in params:
+                self._apply_action(params, schema_params, key, resource_id)
+
+        return params
+
+
+class GatewayDispatchedInit(object):
+    """Replaces a resource's __init__ while gateway-bound namespaces are active.
+
+    Resources are constructed with the gateway that fetched them,
+    which selects the replacement of the namespace bound to it.
+    """
+
+    def __init__(self, method):
+        self.method = method
+        self.replacements = {}
+
+    def __call__(self, receiver, *args, **kwargs):
+        gateway = args[0] if args else kwargs.get('gateway')
+        replacement = self.replacements.get(gateway, self.method)
+        return replacement(receiver, *args, **kwargs)
+
+    def __get__(self, obj, objtype):
+        if obj is None:
+            return self.__call__
+
+        return bind(self, obj, objtype)
+
+
+_shared_patches_lock = threading.Lock()
+_shared_patches = {}
+
+
+class SharedPatcher(object):
+    """Like mock.patch.object, but may be started by many gateway-bound namespaces at once.
+
+    The first start installs the patch and the last stop removes it,
+    regardless of the order namespaces are entered and exited in.
+    Starting one that's already started, or stopping one that isn't, does nothing,
+    so a namespace exited twice never removes a patch another namespace still needs.
+    """
+
+    def __init__(self, target, attribute, new):
+        self.target = target
+        self.attribute = attribute
+        self.new = new
+        self._counted = False
+
+    def start(self):
+        key = (self.target, self.attribute)
+
+        with _shared_patches_lock:
+            if self._counted:
+                return
+            self._counted = True
+
+            if key not in _shared_patches:
+                patcher = patch.object(self.target, self.attribute, self.new)
+                patcher.start()
+                _shared_patches[key] = [patcher, self.new, 0]
+
+            shared = _shared_patches[key]
+            shared[2] += 1
+            self._started(shared[1])
+
+    def stop(self):
+        key = (self.target, self.attribute)
+
+        with _shared_patches_lock:
+            if not self._counted:
+                return
+            self._counted = False
+
+            shared = _shared_patches[key]
+            self._stopped(shared[1])
+
+            shared[2] -= 1
+            if shared[2] == 0:
+                shared[0].stop()
+                del _shared_patches[key]
+
+    def _started(self, installed):
+        pass
+
+    def _stopped(self, installed):
+        pass
+
+
+class GatewayInitPatcher(SharedPatcher):
+    """Routes construction of bt_class with gateway through replacement."""
+
+    def __init__(self, bt_class, gateway, replacement):
+        super(GatewayInitPatcher, self).__init__(
+            bt_class, '__init__', GatewayDispatchedInit(replacement.method))
+        self.gateway = gateway
+        self.replacement = replacement
+
+    def _started(self, dispatcher):
+        dispatcher.replacements[self.gateway] = self.replacement
+
+    def _stopped(self, dispatcher):
+        del dispatcher.replacements[self.gateway]
 
 
 class SchemaPatcher(object):
-    def __init__(self, options):
-        self._action_state = {}
+    def __init__(self, options, gateway=None, thread_safe=False, id_token=None,
+                 rewrite_responses=False):
+        """
+        :param options
+        :param gateway: (optional) a braintree.BraintreeGateway. When provided, only calls
+          made through it (and resources it constructs) are patched.
+        :param thread_safe: (optional) if True, action state may be shared between threads.
+        :param id_token: (optional) if provided, actions derive real ids from it instead of
+          mapping them.
+        :param rewrite_responses: (optional) if True, __init__ schemas are handled by
+          response_rewriter rather than by patching __init__.
+        """
+
+        self._action_state = {'id_token': id_token}
+        init_state(self._action_state, thread_safe)
         self.options = options
+        self.gateway = gateway
+
+        self.response_rewriter = None
+        if rewrite_responses:
+            self.response_rewriter = ResponseRewriter(XmlUtil.dict_from_xml,
+                                                      self._action_state, options)
+
+    def reset_state(self):
+        """Forget everything actions have recorded. Patchers that were created remain valid."""
+
+        thread_safe = 'class_locks' in self._action_state
+        id_token = self._action_state['id_token']
+
+        # Patched methods hold a reference to this dict, so it's cleared in place.
+        self._action_state.clear()
+        self._action_state['id_token'] = id_token
+        init_state(self._action_state, thread_safe)
+
+    def _replacement(self, original_method, call_schema):
+        if call_schema.method_name == '__init__':
+            return PatchedInit(original_method, self._action_state, call_schema, self.options)
+        return PatchedMethod(original_method, self._action_state, call_schema, self.options)
 
     def create_patchers(self, call_schemas):
         patchers = []
 
         for call_schema in call_schemas:
-            bt_class = call_schema.bt_class
-            original_method = getattr(bt_class, call_schema.method_name)
-
-            replacement = PatchedMethod(original_method, self._action_state,
-                                        call_schema, self.options)
-            patchers.append(patch.object(bt_class, call_schema.method_name, replacement))
+            patchers.extend(self.create_schema_patchers(call_schema))
 
         return patchers
+
+    def create_schema_patchers(self, call_schema):
+        """Return the patchers for one schema. There are none if its method isn't available.
+
+        Patchers are created from the method as it is now, so a schema's patchers
+        should be created after any others for the same method are stopped.
+        """
+
+        if self.response_rewriter is not None and call_schema.method_name == '__init__':
+            # Resources are rewritten as responses are parsed instead.
+            return [ResponseSchemaPatcher(self.response_rewriter, call_schema)]
+
+        if self.gateway is None:
+            patcher = self._create_patcher(call_schema)
+        else:
+            patcher = self._create_gateway_patcher(call_schema)
+
+        if patcher is None:
+            return []
+
+        return [patcher]
+
+    def _create_patcher(self, call_schema):
+        bt_class = call_schema.bt_class
+        original_method = getattr(bt_class, call_schema.method_name)
+
+        replacement = self._replacement(original_method, call_schema)
+        return patch.object(bt_class, call_schema.method_name, replacement)
+
+    def _create_gateway_patcher(self, call_schema):
+        bt_class = call_schema.bt_class
+
+        if call_schema.method_name == '__init__':
+            original_method = bt_class.__dict__.get('__init__')
+            if isinstance(original_method, GatewayDispatchedInit):
+                # Another gateway-bound namespace is active.
+                original_method = original_method.method
+            else:
+                original_method = bt_class.__init__
+
+            if 'gateway' not in getargnames(original_method):
+                logger.debug("%s isn't constructed with a gateway; skipping", bt_class)
+                return None
+
+            replacement = self._replacement(original_method, call_schema)
+            return GatewayInitPatcher(bt_class, self.gateway, replacement)
+
+        target = getattr(self.gateway, gateway_attributes.get(bt_class, ''), None)
+        if not hasattr(target, call_schema.method_name):
+            logger.debug("the gateway doesn't provide %s.%s; skipping",
+                         bt_class, call_schema.method_name)
+            return None
+
+        original_method = getattr(target, call_schema.method_name)
+        replacement = PatchedMethod(original_method, self._action_state,
+                                    call_schema, self.options)
+        return patch.object(target, call_schema.method_name, replacement)
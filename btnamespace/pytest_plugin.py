@@ -0,0 +1,123 @@
+"""
+A pytest plugin providing the bt_namespace fixture.
+
+The namespace is patched in once per session; each test gets a fresh state
+by resetting it, which is much cheaper than entering a new Namespace.
+It's registered automatically when btnamespace is installed.
+"""
+
+from builtins import object
+import collections
+import threading
+import time
+
+from braintree.util.http import Http
+from mock import patch
+import pytest
+
+from .namespace import Namespace
+
+# Http methods which each send one request to the gateway.
+_HTTP_METHODS = ['get', 'post', 'put', 'delete', 'post_multipart']
+
+GatewayCalls = collections.namedtuple('GatewayCalls', ['count', 'seconds'])
+
+
+class GatewayCallRecorder(object):
+    """Counts and times the gateway requests made during each test."""
+
+    def __init__(self):
+        self.calls = collections.OrderedDict()
+        self.current = None
+        self._lock = threading.Lock()
+
+    def patchers(self):
+        return [patch.object(Http, name, self._recorded(getattr(Http, name)))
+                for name in _HTTP_METHODS if hasattr(Http, name)]
+
+    def _recorded(self, method):
+        def recorded(http, *args, **kwargs):
+            start = time.time()
+            try:
+                return method(http, *args, **kwargs)
+            finally:
+                self.record(time.time() - start)
+        return recorded
+
+    def record(self, seconds):
+        with self._lock:
+            count, total = self.calls.get(self.current, (0, 0.0))
+            self.calls[self.current] = GatewayCalls(count + 1, total + seconds)
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('btnamespace')
+    group.addoption(
+        '--bt-calls-report', type=int, default=10, metavar='N',
+        help="show the N tests spending the most time in braintree gateway calls"
+             " (default 10; 0 disables).")
+
+
+def pytest_configure(config):
+    config._btnamespace_recorder = GatewayCallRecorder()
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_protocol(item, nextitem):
+    recorder = item.config._btnamespace_recorder
+    recorder.current = item.nodeid
+    yield
+    recorder.current = None
+
+
+def pytest_terminal_summary(terminalreporter):
+    config = terminalreporter.config
+    recorder = config._btnamespace_recorder
+    limit = config.getoption('bt_calls_report')
+
+    if not recorder.calls or not limit:
+        return
+
+    calls = sorted(recorder.calls.items(), key=lambda item: item[1].seconds, reverse=True)
+    total = GatewayCalls(sum(c.count for _, c in calls), sum(c.seconds for _, c in calls))
+
+    terminalreporter.write_sep('=', "braintree gateway calls")
+    terminalreporter.write_line("%s calls in %.2fs" % (total.count, total.seconds))
+
+    for nodeid, test_calls in calls[:limit]:
+        terminalreporter.write_line("%7.2fs %5s calls  %s"
+                                    % (test_calls.seconds, test_calls.count,
+                                       nodeid or '(outside of tests)'))
+
+
+@pytest.fixture(scope='session')
+def bt_namespace_kwargs():
+    """Keyword arguments for the session's Namespace. Override this to customize it."""
+    return {}
+
+
+@pytest.fixture(scope='session')
+def bt_namespace_session(request, bt_namespace_kwargs):
+    """A Namespace which is active for the rest of the session once requested."""
+
+    recorder = request.config._btnamespace_recorder
+    patchers = recorder.patchers()
+    namespace = Namespace(**bt_namespace_kwargs)
+
+    for patcher in patchers:
+        patcher.start()
+    namespace.__enter__()
+
+    yield namespace
+
+    namespace.__exit__()
+    for patcher in patchers:
+        patcher.stop()
+
+
+@pytest.fixture
+def bt_namespace(bt_namespace_session):
+    """The session's Namespace, with a fresh state for this test."""
+
+    bt_namespace_session.reset()
+    return bt_namespace_session
@@ -0,0 +1,113 @@
+from builtins import object
+import collections
+import contextlib
+import io
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+RateLimitStats = collections.namedtuple('RateLimitStats',
+                                        ['requests', 'delayed', 'seconds_waited'])
+
+
+class RateLimiter(object):
+    """A token bucket limiting the rate of gateway requests.
+
+    Provide an instance as the 'rate_limit' option of a Namespace to enable it.
+    Requests beyond the burst are queued rather than rejected: each one reserves
+    the next available token and sleeps until it's due.
+
+    When lock_path is provided, the bucket is kept in that file and guarded with
+    a file lock, so every process using the same path shares one rate.
+    """
+
+    def __init__(self, rate, burst=1, lock_path=None):
+        """
+        :param rate: the sustained number of requests per second. It must be positive.
+        :param burst: the number of requests which may be sent at once after a pause,
+          at least 1.
+        :param lock_path: (optional) a file shared by processes which should be limited together.
+        """
+
+        if not rate > 0:
+            raise ValueError("rate must be a positive number of requests per second: %r" % rate)
+        if not burst >= 1:
+            raise ValueError("burst must be at least 1: %r" % burst)
+        if lock_path is not None and fcntl is None:
+            raise ValueError("lock_path requires fcntl, which isn't available on this platform")
+
+        self.rate = float(rate)
+        self.burst = burst
+        self.lock_path = lock_path
+
+        self._lock = threading.Lock()
+        self._bucket = (float(burst), time.time())
+        self._requests = 0
+        self._delayed = 0
+        self._seconds_waited = 0.0
+
+    @contextlib.contextmanager
+    def _locked_bucket(self):
+        """Yield a list of [tokens, updated] which is saved on exit."""
+
+        with self._lock:
+            if self.lock_path is None:
+                bucket = list(self._bucket)
+                yield bucket
+                self._bucket = tuple(bucket)
+                return
+
+            with io.open(self.lock_path, 'a+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    try:
+                        tokens, updated = [float(field) for field in f.read().split()]
+                    except ValueError:
+                        # A new (or damaged) file: start with a full bucket.
+                        tokens, updated = float(self.burst), time.time()
+
+                    bucket = [tokens, updated]
+                    yield bucket
+
+                    f.seek(0)
+                    f.truncate()
+                    f.write(u"%r %r" % tuple(bucket))
+                    f.flush()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def acquire(self):
+        """Take a token, sleeping until one is available. Return the seconds slept."""
+
+        with self._locked_bucket() as bucket:
+            now = time.time()
+            tokens = min(float(self.burst), bucket[0] + (now - bucket[1]) * self.rate)
+
+            # Tokens go negative while requests are queued.
+            tokens -= 1
+            bucket[:] = [tokens, now]
+
+        wait = max(0.0, -tokens / self.rate)
+
+        with self._lock:
+            self._requests += 1
+            if wait:
+                self._delayed += 1
+                self._seconds_waited += wait
+
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def call(self, invoke):
+        self.acquire()
+        return invoke()
+
+    def stats(self):
+        with self._lock:
+            return RateLimitStats(self._requests, self._delayed, self._seconds_waited)
@@ -0,0 +1,148 @@
+"""
+Rewrite ids in gateway responses as they're parsed, rather than as each resource is built.
+
+Patching a resource's __init__ costs an interception for every object constructed,
+including every card of a customer and every transaction of a search page. Instead,
+braintree's XML parser can be patched once: each parsed document is walked a single
+time, and the attributes of any element named for a resource are rewritten according
+to that resource's __init__ schema. The same ResourceId declarations drive both.
+"""
+
+from builtins import str
+from builtins import object
+
+import braintree
+
+from .actions import init_state
+from .shared import INIT_ATTRIBUTES_PARAM, compile_schema_params, result_attribute
+
+# The elements resources appear under, where they aren't named for the class.
+_element_name_overrides = {
+    'CreditCardVerification': 'verification',
+    'PayPalAccount': 'paypal_account',
+    'WebhookNotification': 'notification',
+}
+
+element_name_overrides = dict(
+    (getattr(braintree, class_name), name)
+    for class_name, name in _element_name_overrides.items()
+    if hasattr(braintree, class_name)
+)
+
+# Error responses echo the request's params, which hold real ids that were never
+# part of a response; they're left as they are.
+_skipped_keys = frozenset(['params'])
+
+
+def element_names(bt_class):
+    """Return the names of the elements holding a bt_class, alone and in a list."""
+
+    names = set([result_attribute(bt_class), element_name_overrides.get(bt_class)])
+    names.discard(None)
+
+    plurals = set(name + ('es' if name.endswith('s') else 's') for name in names)
+    return names | plurals
+
+
+class ResponseRewriter(object):
+    """Replaces XmlUtil.dict_from_xml, rewriting the ids of resources in what it parses."""
+
+    def __init__(self, method, state, options):
+        """
+        :param method: the original dict_from_xml
+        :param state: the state dictionary to provide to actions
+        :param options: dictionary with arbitrary contents passed through to actions
+        """
+
+        self.method = method
+        self.state = state
+        self.options = options
+
+        # element name -> (__init__ CallSchema, its compiled attributes)
+        self._elements = {}
+
+    def add(self, call_schema):
+        compiled = compile_schema_params(call_schema.params.get(INIT_ATTRIBUTES_PARAM, {}))
+        for name in element_names(call_schema.bt_class):
+            self._elements[name] = (call_schema, compiled)
+
+    def remove(self, call_schema):
+        for name in element_names(call_schema.bt_class):
+            if self._elements.get(name, (None,))[0] is call_schema:
+                del self._elements[name]
+
+    def __call__(self, *args, **kwargs):
+        parsed = self.method(*args, **kwargs)
+
+        if not getattr(self.state['calls'], 'paused', False):
+            init_state(self.state)
+            self.rewrite(parsed, set())
+
+        return parsed
+
+    def __get__(self, obj, objtype):
+        # This replaces a staticmethod; never provide the receiver.
+        return self.__call__
+
+    def rewrite(self, node, rewritten):
+        """Rewrite the resources in a parsed document, in place.
+
+        Resources are rewritten before those nested in them, the order their
+        __init__s would run in, so creation ids are mapped to the right resource.
+
+        :param rewritten: (id(dict), key) pairs which have already been rewritten,
+          in case a resource's schema covers an element that's also named for a resource.
+        """
+
+        if isinstance(node, list):
+            for item in node:
+                self.rewrite(item, rewritten)
+            return
+
+        if not isinstance(node, dict):
+            return
+
+        for key, value in node.items():
+            if key in _skipped_keys:
+                continue
+
+            element = self._elements.get(key)
+            if element is not None:
+                for resource in (value if isinstance(value, list) else [value]):
+                    if isinstance(resource, dict):
+                        self._rewrite_resource(resource, element[0], element[1], rewritten)
+
+            self.rewrite(value, rewritten)
+
+    def _rewrite_resource(self, params, call_schema, compiled, rewritten):
+        schema_params, resource_ids, nested = compiled
+
+        for key, resource_id in resource_ids:
+            if params.get(key) is None or (id(params), key) in rewritten:
+                continue
+
+            provided_id = params[key] = str(params[key])
+            resource_id.action(params, schema_params, key, resource_id, self.state, self.options)
+            rewritten.add((id(params), key))
+
+            trace = self.options.get('trace')
+            if trace is not None:
+                trace.record(provided_id, params.get(key), resource_id, call_schema)
+
+        for key, nested_compiled in nested:
+            if isinstance(params.get(key), dict):
+                self._rewrite_resource(params[key], call_schema, nested_compiled, rewritten)
+
+
+class ResponseSchemaPatcher(object):
+    """Has a ResponseRewriter handle an __init__ schema while started."""
+
+    def __init__(self, rewriter, call_schema):
+        self.rewriter = rewriter
+        self.call_schema = call_schema
+
+    def start(self):
+        self.rewriter.add(self.call_schema)
+
+    def stop(self):
+        self.rewriter.remove(self.call_schema)
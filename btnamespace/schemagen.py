@@ -0,0 +1,347 @@
+"""
+Generate CallSchemas for the parts of the braintree library not covered by schemas.schemas.
+
+Generation introspects the installed braintree package, so its output is cached
+to a file keyed by the braintree and btnamespace versions.
+"""
+
+from builtins import str
+import inspect
+import io
+import json
+import logging
+import os
+import tempfile
+
+import braintree
+
+from ._version import __version__
+from .actions import clear_old_creation_ids
+from .compat import getargnames
+from .schemas import creation_id, fake_id, real_id, schema, schemas
+from .shared import snake_case
+
+logger = logging.getLogger(__name__)
+
+# Resources that are configured per merchant rather than created by tests.
+UNNAMESPACED_CLASSES = ['AddOn', 'Discount', 'Merchant', 'MerchantAccount', 'Plan']
+
+# All payment methods share one token space, which is tracked under CreditCard.
+PAYMENT_METHOD_CLASS = 'CreditCard'
+
+# Param names that refer to a resource but can't be derived from class names.
+REFERENCE_ALIASES = {
+    'billing_address_id': 'Address',
+    'shipping_address_id': 'Address',
+    'default_payment_method_token': PAYMENT_METHOD_CLASS,
+    'payment_method_token': PAYMENT_METHOD_CLASS,
+    'update_existing_token': PAYMENT_METHOD_CLASS,
+}
+
+# Keys of nested params that describe a resource.
+NESTED_RESOURCES = {
+    'android_pay_card': PAYMENT_METHOD_CLASS,
+    'android_pay_network_token': PAYMENT_METHOD_CLASS,
+    'apple_pay_card': PAYMENT_METHOD_CLASS,
+    'credit_card': PAYMENT_METHOD_CLASS,
+    'customer': 'Customer',
+}
+
+_resource_id_factories = {
+    'creation_id': creation_id,
+    'fake_id': fake_id,
+    'real_id': real_id,
+}
+
+_loaded_schemas = {}
+
+
+def _is_id_name(name):
+    return name in ('id', 'token') or name.endswith('_id') or name.endswith('_token')
+
+
+def _id_key(map_class):
+    return 'token' if map_class == PAYMENT_METHOD_CLASS else 'id'
+
+
+def _bt_classes():
+    for name in sorted(dir(braintree)):
+        cls = getattr(braintree, name)
+        if ((inspect.isclass(cls) and cls.__name__ == name
+             and cls.__module__.startswith('braintree')
+             and name not in UNNAMESPACED_CLASSES)):
+            yield cls
+
+
+def _static_methods(cls):
+    for name, attr in sorted(cls.__dict__.items()):
+        if isinstance(attr, staticmethod) and not name.startswith('_'):
+            yield name, attr.__func__
+
+
+def _signature_for(cls, method_name):
+    if method_name == 'clone_transaction':
+        method_name = 'clone'
+
+    signature = getattr(cls, method_name + '_signature', None)
+    if signature is None:
+        return None
+
+    try:
+        return signature()
+    except TypeError:
+        # Some signatures depend on arguments we can't provide, eg a payment method type.
+        return None
+
+
+def _namespaced_classes():
+    """Return a dict of class name -> (find argument, name of the class whose id map is used)."""
+
+    namespaced = {}
+
+    for cls in _bt_classes():
+        find = cls.__dict__.get('find')
+        if not isinstance(find, staticmethod):
+            continue
+
+        id_args = [arg for arg in getargnames(find.__func__) if _is_id_name(arg)]
+        if not id_args:
+            continue
+
+        # Prefer arguments named for the class. Otherwise, parent ids come first,
+        # eg PayPalAccount.find(paypal_account_token) or Address.find(customer_id, address_id).
+        own_args = [arg for arg in id_args
+                    if arg in ('id', 'token') or arg.startswith(snake_case(cls.__name__) + '_')]
+        key = own_args[0] if own_args else id_args[-1]
+        if key == 'token' or key.endswith('_token'):
+            namespaced[cls.__name__] = (key, PAYMENT_METHOD_CLASS)
+        else:
+            namespaced[cls.__name__] = (key, cls.__name__)
+
+    return namespaced
+
+
+def _reference_names(namespaced):
+    """Return a dict of param name -> name of the class whose id map it refers to."""
+
+    references = {}
+
+    for name, (key, map_class) in namespaced.items():
+        if key not in ('id', 'token'):
+            references[key] = map_class
+
+    # Names derived from classes take precedence over find arguments.
+    for name, (key, map_class) in namespaced.items():
+        suffix = '_token' if map_class == PAYMENT_METHOD_CLASS else '_id'
+        references[snake_case(name) + suffix] = map_class
+
+    references.update(REFERENCE_ALIASES)
+    return references
+
+
+def _walk_signature(signature, context, references, method_name):
+    """Build schema params from a braintree params signature.
+
+    :param context: the id map class name of the resource these params describe, or None
+    """
+
+    if isinstance(signature, dict):
+        signature = [signature]
+
+    params = {}
+
+    for item in sorted(signature, key=lambda item: isinstance(item, dict)):
+        if isinstance(item, dict):
+            for key, subsignature in sorted(item.items()):
+                if isinstance(subsignature, (list, set, tuple, dict)):
+                    nested = _walk_signature(subsignature, NESTED_RESOURCES.get(key),
+                                             references, method_name)
+                    if nested:
+                        params[key] = nested
+        elif context is not None and item == _id_key(context):
+            # Updates can change ids, which we don't support.
+            if method_name == 'create':
+                params[item] = ['creation_id', context]
+        elif item in references:
+            params[item] = ['fake_id', references[item]]
+
+    return params
+
+
+def _method_specs(cls, namespaced, references):
+    own = namespaced.get(cls.__name__)
+    specs = []
+
+    for method_name, func in _static_methods(cls):
+        if method_name.endswith('signature'):
+            continue
+
+        params = {}
+        for arg in getargnames(func):
+            if own is not None and arg in ('id', 'token', own[0]):
+                params[arg] = ['fake_id', own[1]]
+            elif arg in references:
+                params[arg] = ['fake_id', references[arg]]
+            elif arg == 'params':
+                signature = _signature_for(cls, method_name)
+                if signature is not None:
+                    nested = _walk_signature(signature, own and own[1], references, method_name)
+                    if nested:
+                        params[arg] = nested
+
+        if params:
+            specs.append({
+                'bt_class': cls.__name__,
+                'method_name': method_name,
+                'start_hook': True,
+                'params': params,
+            })
+
+    return specs
+
+
+def _init_spec(cls, namespaced, references):
+    _, map_class = namespaced[cls.__name__]
+
+    try:
+        init_args = getargnames(cls.__init__)
+    except TypeError:
+        # object.__init__ and other builtins can't be introspected.
+        return None
+
+    if 'attributes' not in init_args:
+        return None
+
+    attributes = {_id_key(map_class): ['real_id', map_class]}
+    if map_class == PAYMENT_METHOD_CLASS:
+        attributes['customer_id'] = ['real_id', 'Customer']
+
+    for item in _signature_for(cls, 'create') or []:
+        if not isinstance(item, dict) and item in references:
+            attributes[item] = ['real_id', references[item]]
+
+    return {
+        'bt_class': cls.__name__,
+        'method_name': '__init__',
+        'start_hook': False,
+        'params': {'attributes': attributes},
+    }
+
+
+def generate_specs():
+    """Introspect the braintree package and return a list of json-serializable schema specs.
+
+    Methods already covered by schemas.schemas are omitted.
+    """
+
+    namespaced = _namespaced_classes()
+    references = _reference_names(namespaced)
+    handwritten = set((s.bt_class.__name__, s.method_name) for s in schemas)
+
+    specs = []
+    for cls in _bt_classes():
+        specs.extend(_method_specs(cls, namespaced, references))
+
+        if cls.__name__ in namespaced:
+            init_spec = _init_spec(cls, namespaced, references)
+            if init_spec is not None:
+                specs.append(init_spec)
+
+    return [spec for spec in specs
+            if (spec['bt_class'], spec['method_name']) not in handwritten]
+
+
+def _build_params(spec_params):
+    params = {}
+
+    for key, val in spec_params.items():
+        if isinstance(val, dict):
+            params[key] = _build_params(val)
+        else:
+            factory_name, class_name = val
+            params[key] = _resource_id_factories[factory_name](getattr(braintree, class_name))
+
+    return params
+
+
+def build_schemas(specs):
+    """Turn specs from generate_specs into CallSchemas."""
+
+    call_schemas = []
+
+    for spec in specs:
+        bt_class = getattr(braintree, spec['bt_class'], None)
+        if bt_class is None or not hasattr(bt_class, spec['method_name']):
+            logger.warning("skipping schema for missing method %s.%s",
+                           spec['bt_class'], spec['method_name'])
+            continue
+
+        call_schemas.append(schema(
+            bt_class=bt_class,
+            method_name=spec['method_name'],
+            start_hook=clear_old_creation_ids if spec['start_hook'] else None,
+            params=_build_params(spec['params']),
+        ))
+
+    return call_schemas
+
+
+def default_cache_dir():
+    return os.path.join(os.path.expanduser('~'), '.cache', 'btnamespace')
+
+
+def cache_path(cache_dir=None):
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+
+    filename = 'schemas-%s-braintree-%s.json' % (__version__, braintree.version.Version)
+    return os.path.join(cache_dir, filename)
+
+
+def _read_specs(path):
+    try:
+        with io.open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _write_specs(path, specs):
+    directory = os.path.dirname(path)
+
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # Write then rename, so concurrent readers never see a partial file.
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with io.open(fd, 'w', encoding='utf-8') as f:
+            f.write(str(json.dumps(specs, indent=1, sort_keys=True)))
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        logger.warning("could not write generated schemas to %r", path, exc_info=True)
+
+
+def generated_schemas(cache_dir=None):
+    """Return CallSchemas for braintree methods that schemas.schemas doesn't cover.
+
+    They're read from the cache when possible, and generated and cached otherwise.
+    Provide them to a Namespace along with the default schemas, eg::
+
+        Namespace(custom_schemas=schemas + generated_schemas())
+
+    :param cache_dir: (optional) the directory holding cached output.
+      Defaults to ~/.cache/btnamespace.
+    """
+
+    path = cache_path(cache_dir)
+
+    if path not in _loaded_schemas:
+        specs = _read_specs(path)
+        if specs is None:
+            specs = generate_specs()
+            _write_specs(path, specs)
+
+        _loaded_schemas[path] = build_schemas(specs)
+
+    return list(_loaded_schemas[path])
@@ -3,6 +3,7 @@ import braintree
 from .actions import (
     clear_old_creation_ids,
     convert_to_real_id,
+    convert_webhook_subject_to_real_id,
     delete_and_store,
     convert_to_fake_id
 )
@@ -21,6 +22,10 @@ def real_id(bt_class):
     return ResourceId(bt_class, action=convert_to_fake_id)
 
 
+def webhook_subject_id():
+    return ResourceId(braintree.WebhookNotification, action=convert_webhook_subject_to_real_id)
+
+
 def schema(**kwargs):
     if 'start_hook' not in kwargs:
         kwargs['start_hook'] = None
@@ -139,6 +144,8 @@ schemas = [
         params={
             'attributes': {
                 'id': real_id(braintree.Transaction),
+                # Set on refunds.
+                'refunded_transaction_id': real_id(braintree.Transaction),
             }
         }
     ),
@@ -168,7 +175,31 @@ schemas = [
             'transaction_id': fake_id(braintree.Transaction),
         }
     ),
-    # Transactions can not be deleted nor updated.
+    # Transactions can not be deleted nor updated, but move through a lifecycle.
+    schema(
+        bt_class=braintree.Transaction,
+        method_name='submit_for_settlement',
+        start_hook=clear_old_creation_ids,
+        params={
+            'transaction_id': fake_id(braintree.Transaction),
+        }
+    ),
+    schema(
+        bt_class=braintree.Transaction,
+        method_name='void',
+        start_hook=clear_old_creation_ids,
+        params={
+            'transaction_id': fake_id(braintree.Transaction),
+        }
+    ),
+    schema(
+        bt_class=braintree.Transaction,
+        method_name='refund',
+        start_hook=clear_old_creation_ids,
+        params={
+            'transaction_id': fake_id(braintree.Transaction),
+        }
+    ),
 
     # client tokens
     schema(
@@ -180,4 +211,67 @@ schemas = [
             }
         }
     ),
+
+    # sandbox-only transitions
+    schema(
+        bt_class=braintree.TestingGateway,
+        method_name='settle_transaction',
+        start_hook=clear_old_creation_ids,
+        params={
+            'transaction_id': fake_id(braintree.Transaction),
+        }
+    ),
+    schema(
+        bt_class=braintree.TestingGateway,
+        method_name='settlement_confirm_transaction',
+        start_hook=clear_old_creation_ids,
+        params={
+            'transaction_id': fake_id(braintree.Transaction),
+        }
+    ),
+    schema(
+        bt_class=braintree.TestingGateway,
+        method_name='settlement_decline_transaction',
+        start_hook=clear_old_creation_ids,
+        params={
+            'transaction_id': fake_id(braintree.Transaction),
+        }
+    ),
+    schema(
+        bt_class=braintree.TestingGateway,
+        method_name='settlement_pending_transaction',
+        start_hook=clear_old_creation_ids,
+        params={
+            'transaction_id': fake_id(braintree.Transaction),
+        }
+    ),
+
+    # webhooks
+    schema(
+        bt_class=braintree.WebhookNotification,
+        method_name='__init__',
+        params={
+            # Transaction subjects are handled by Transaction.__init__.
+            'attributes': {
+                'subject': {
+                    'transaction_review': {
+                        'transaction_id': real_id(braintree.Transaction),
+                    },
+                    'dispute': {
+                        'transaction': {
+                            'id': real_id(braintree.Transaction),
+                        }
+                    },
+                }
+            }
+        }
+    ),
+    schema(
+        bt_class=braintree.WebhookTesting,
+        method_name='sample_notification',
+        start_hook=clear_old_creation_ids,
+        params={
+            'id': webhook_subject_id(),
+        }
+    ),
 ]
@@ -1,11 +1,42 @@
 from builtins import object
 import collections
+import re
 
 
 ResourceId = collections.namedtuple('ResourceId', ['bt_class', 'action'])
 CallSchema = collections.namedtuple('CallSchema', ['bt_class', 'method_name',
                                                    'start_hook', 'params'])
 
+# The argument of a resource's __init__ which holds its attributes.
+INIT_ATTRIBUTES_PARAM = 'attributes'
+
+
+def compile_schema_params(schema_params):
+    """Split schema params into their ResourceIds and nested params, once.
+
+    Returns (schema_params, [(key, ResourceId)], [(key, compiled nested params)]).
+    Both ways of rewriting resources (PatchedInit and ResponseRewriter) walk this.
+    """
+
+    resource_ids = [(key, val) for key, val in schema_params.items()
+                    if isinstance(val, ResourceId)]
+    nested = [(key, compile_schema_params(val)) for key, val in schema_params.items()
+              if isinstance(val, dict)]
+    return schema_params, resource_ids, nested
+
+
+def snake_case(name):
+    """eg CreditCard -> credit_card"""
+    return re.sub(r'(?<!^)(?=[A-Z])', '_', name).lower()
+
+
+def result_attribute(bt_class):
+    """Return the name braintree uses for bt_class in results and errors.
+
+    eg CreditCard.create returns a result with a credit_card attribute.
+    """
+    return snake_case(bt_class.__name__)
+
 
 class NamespaceError(Exception):
     pass
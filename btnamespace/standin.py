@@ -0,0 +1,490 @@
+"""
+A local stand-in for the braintree gateway.
+
+It implements the operations covered by schemas.schemas, and a few covered by generated
+schemas, against an in-memory store, so namespaced code can be exercised without a sandbox
+account or network access.
+Responses are only as detailed as the namespace needs; they're not a substitute
+for testing against the sandbox.
+
+Latency, timeouts, errors and throttling can be modeled too, to see how namespaced
+workloads behave under gateway conditions that the sandbox can't be asked for.
+"""
+
+from __future__ import division
+
+from builtins import object
+import collections
+import functools
+import math
+import random
+import re
+import threading
+import time
+import uuid
+
+import braintree
+from braintree.util.http import Http
+from braintree.util.parser import Parser
+from braintree.util.xml_util import XmlUtil
+import requests
+
+# Validation error codes the gateway uses for ids which are already taken.
+CUSTOMER_ID_TAKEN = braintree.ErrorCodes.Customer.IdIsInUse
+CREDIT_CARD_TOKEN_TAKEN = braintree.ErrorCodes.CreditCard.TokenIsInUse
+CANNOT_REFUND_UNSETTLED = braintree.ErrorCodes.Transaction.CannotRefundUnlessSettled
+CANNOT_UPDATE_DETAILS = (
+    braintree.ErrorCodes.Transaction.CannotUpdateTransactionDetailsNotSubmittedForSettlement)
+
+_SUBMITTED = 'submitted_for_settlement'
+
+# Transaction lifecycle paths -> (new status, statuses it may follow, error code otherwise).
+# All but submit_for_settlement and void are sandbox-only testing operations.
+_transitions = {
+    'submit_for_settlement': (_SUBMITTED, ['authorized'],
+                              braintree.ErrorCodes.Transaction.CannotSubmitForSettlement),
+    'void': ('voided', ['authorized', _SUBMITTED],
+             braintree.ErrorCodes.Transaction.CannotBeVoided),
+    'settle': ('settled', [_SUBMITTED],
+               braintree.ErrorCodes.Transaction.CannotSubmitForSettlement),
+    'settlement_confirm': ('settlement_confirmed', [_SUBMITTED],
+                           braintree.ErrorCodes.Transaction.CannotSubmitForSettlement),
+    'settlement_decline': ('settlement_declined', [_SUBMITTED],
+                           braintree.ErrorCodes.Transaction.CannotSubmitForSettlement),
+    'settlement_pending': ('settlement_pending', [_SUBMITTED],
+                           braintree.ErrorCodes.Transaction.CannotSubmitForSettlement),
+}
+
+
+StandinStats = collections.namedtuple('StandinStats', ['requests', 'timeouts', 'errors',
+                                                       'throttled'])
+
+
+# Distributions are partials of module functions so they can be pickled for other processes.
+
+def _constant(seconds, rng):
+    return seconds
+
+
+def _lognormal(median, sigma, rng):
+    return rng.lognormvariate(math.log(median), sigma)
+
+
+def _exponential(mean, rng):
+    return rng.expovariate(1 / mean)
+
+
+def _uniform(low, high, rng):
+    return rng.uniform(low, high)
+
+
+def constant(seconds):
+    """Return a latency distribution which always takes seconds."""
+    return functools.partial(_constant, seconds)
+
+
+def uniform(low, high):
+    return functools.partial(_uniform, low, high)
+
+
+def exponential(mean):
+    return functools.partial(_exponential, mean)
+
+
+def lognormal(median, sigma):
+    """Return a long-tailed latency distribution, like those of most real services.
+
+    :param sigma: the standard deviation of the latency's logarithm; larger values
+      give a longer tail.
+    """
+    return functools.partial(_lognormal, median, sigma)
+
+
+def _generated_id():
+    return uuid.uuid4().hex[:8]
+
+
+def _error_response(resource, attribute, code, message):
+    return 422, XmlUtil.xml_from_dict({'api_error_response': {
+        'errors': {
+            'errors': [],
+            resource: {'errors': [{'code': code, 'attribute': attribute, 'message': message}]},
+        },
+        'message': message,
+        'params': {},
+    }})
+
+
+def _expiration(params):
+    # CreditCard.expiration_date is a property derived from these.
+    month, _, year = (params.get('expiration_date') or '/').partition('/')
+    return {'expiration_month': params.get('expiration_month', month),
+            'expiration_year': params.get('expiration_year', year)}
+
+
+def _nested(params, key):
+    # Empty elements are parsed as empty strings.
+    return params.get(key) or {}
+
+
+class StandinHttp(Http):
+    """A braintree http strategy which sends requests to a StandinGateway."""
+
+    def __init__(self, config, environment, standin):
+        Http.__init__(self, config, environment)
+        self.standin = standin
+
+    def http_do(self, http_verb, path, headers, request_body):
+        if type(request_body) is tuple:
+            request_body = request_body[0]
+
+        delay = self.standin.delay()
+        if delay >= self.config.timeout:
+            time.sleep(self.config.timeout)
+            self.standin.record_timeout()
+            raise requests.exceptions.ReadTimeout(
+                "stand-in request took longer than %ss" % self.config.timeout)
+        time.sleep(delay)
+
+        # Requests are parsed directly, since a namespace may be rewriting what
+        # XmlUtil.dict_from_xml returns (see the 'response' engine).
+        params = Parser(request_body).parse() if request_body else {}
+        return self.standin.handle(http_verb, path, params)
+
+
+class StandinGateway(object):
+    """An in-memory gateway. Configure braintree to use it with::
+
+        standin = StandinGateway()
+        braintree.Configuration.configure(
+            braintree.Environment.Development, 'merchant_id', 'public_key', 'private_key',
+            http_strategy=standin.http_strategy())
+
+    By default requests are answered immediately and never fail.
+    Requests which would take longer than the client's configured timeout
+    sleep for the timeout and raise requests.exceptions.ReadTimeout, as braintree's
+    own http strategy does.
+    """
+
+    def __init__(self, latency=None, jitter=0.0, timeout_rate=0.0, error_rate=0.0,
+                 throttle_rate=0.0, max_rate=None, seed=None):
+        """
+        :param latency: (optional) the seconds each request takes, or a distribution
+          to draw them from, such as lognormal(.2, .5).
+        :param jitter: (optional) each request's latency is varied by up to this many
+          seconds either way.
+        :param timeout_rate: (optional) the fraction of requests which never respond.
+        :param error_rate: (optional) the fraction of requests which fail with a 500.
+        :param throttle_rate: (optional) the fraction of requests which are rejected with a 429.
+        :param max_rate: (optional) requests beyond this many in a second are also
+          rejected with a 429.
+        :param seed: (optional) seeds the random choices, to repeat a run.
+        """
+
+        if latency is not None and not callable(latency):
+            latency = constant(latency)
+
+        self.latency = latency
+        self.jitter = jitter
+        self.timeout_rate = timeout_rate
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.max_rate = max_rate
+
+        self.customers = {}
+        self.credit_cards = {}
+        self.transactions = {}
+
+        self._lock = threading.Lock()
+        self._rng = random.Random(seed)
+        self._recent = collections.deque()
+        self._requests = 0
+        self._timeouts = 0
+        self._errors = 0
+        self._throttled = 0
+        self._routes = [
+            ('POST', r'/customers', self._create_customer),
+            ('GET', r'/customers/([^/?]+)', self._find_customer),
+            ('PUT', r'/customers/([^/?]+)', self._update_customer),
+            ('DELETE', r'/customers/([^/?]+)', self._delete_customer),
+            ('POST', r'/payment_methods', self._create_credit_card),
+            ('GET', r'/payment_methods/credit_card/([^/?]+)', self._find_credit_card),
+            ('PUT', r'/payment_methods/credit_card/([^/?]+)', self._update_credit_card),
+            ('DELETE', r'/payment_methods/credit_card/([^/?]+)', self._delete_credit_card),
+            ('POST', r'/transactions', self._create_transaction),
+            ('GET', r'/transactions/([^/?]+)', self._find_transaction),
+            ('PUT', r'/transactions/([^/?]+)/(%s)' % '|'.join(_transitions), self._transition),
+            ('POST', r'/transactions/([^/?]+)/refund', self._refund_transaction),
+            ('PUT', r'/transactions/([^/?]+)/update_details', self._update_transaction_details),
+            ('POST', r'/client_token', self._generate_client_token),
+        ]
+
+    def http_strategy(self):
+        """Return a factory suitable for braintree's http_strategy configuration."""
+        return functools.partial(StandinHttp, standin=self)
+
+    def stats(self):
+        with self._lock:
+            return StandinStats(self._requests, self._timeouts, self._errors, self._throttled)
+
+    def delay(self):
+        """Return the seconds the next request takes to respond, which may be infinite."""
+
+        with self._lock:
+            self._requests += 1
+
+            if self.timeout_rate and self._rng.random() < self.timeout_rate:
+                return float('inf')
+
+            seconds = self.latency(self._rng) if self.latency is not None else 0.0
+            if self.jitter:
+                seconds += self._rng.uniform(-self.jitter, self.jitter)
+
+        return max(0.0, seconds)
+
+    def record_timeout(self):
+        with self._lock:
+            self._timeouts += 1
+
+    def _fault(self):
+        """Return the status of an injected failure for the current request, or None."""
+
+        now = time.time()
+
+        with self._lock:
+            if self.max_rate is not None:
+                while self._recent and self._recent[0] <= now - 1:
+                    self._recent.popleft()
+                if len(self._recent) >= self.max_rate:
+                    self._throttled += 1
+                    return 429
+                self._recent.append(now)
+
+            if self.throttle_rate and self._rng.random() < self.throttle_rate:
+                self._throttled += 1
+                return 429
+
+            if self.error_rate and self._rng.random() < self.error_rate:
+                self._errors += 1
+                return 500
+
+        return None
+
+    def handle(self, http_verb, path, params):
+        """Return a (status, body) response to a request."""
+
+        fault = self._fault()
+        if fault is not None:
+            return fault, ''
+
+        path = re.sub(r'^.*?/merchants/[^/]+', '', path).split('?')[0]
+
+        for verb, pattern, handler in self._routes:
+            match = re.match(pattern + '$', path)
+            if verb == http_verb and match:
+                with self._lock:
+                    return handler(params, *match.groups())
+
+        return 404, ''
+
+    def _customer_response(self, customer_id):
+        customer = dict(self.customers[customer_id])
+        customer['credit_cards'] = [self.credit_cards[token] for token in customer['tokens']]
+        del customer['tokens']
+        return XmlUtil.xml_from_dict({'customer': customer})
+
+    def _store_credit_card(self, params, customer_id):
+        token = params.get('token') or _generated_id()
+        self.credit_cards[token] = dict(
+            _expiration(params),
+            token=token,
+            customer_id=customer_id,
+            last_4=(params.get('number') or '')[-4:],
+        )
+        self.customers[customer_id]['tokens'].append(token)
+        return token
+
+    def _create_customer(self, params):
+        params = _nested(params, 'customer')
+        customer_id = params.get('id') or _generated_id()
+
+        if customer_id in self.customers:
+            return _error_response('customer', 'id', CUSTOMER_ID_TAKEN,
+                                   'Customer ID has already been taken.')
+
+        card_params = _nested(params, 'credit_card')
+        if card_params.get('token') in self.credit_cards:
+            return _error_response('credit_card', 'token', CREDIT_CARD_TOKEN_TAKEN,
+                                   'Token is in use.')
+
+        self.customers[customer_id] = {
+            'id': customer_id,
+            'first_name': params.get('first_name'),
+            'last_name': params.get('last_name'),
+            'tokens': [],
+        }
+        if card_params:
+            self._store_credit_card(card_params, customer_id)
+
+        return 201, self._customer_response(customer_id)
+
+    def _find_customer(self, params, customer_id):
+        if customer_id not in self.customers:
+            return 404, ''
+        return 200, self._customer_response(customer_id)
+
+    def _update_customer(self, params, customer_id):
+        if customer_id not in self.customers:
+            return 404, ''
+
+        params = _nested(params, 'customer')
+        for key in ('first_name', 'last_name'):
+            if key in params:
+                self.customers[customer_id][key] = params[key]
+
+        return 200, self._customer_response(customer_id)
+
+    def _delete_customer(self, params, customer_id):
+        if customer_id not in self.customers:
+            return 404, ''
+
+        for token in self.customers.pop(customer_id)['tokens']:
+            del self.credit_cards[token]
+        return 200, ''
+
+    def _create_credit_card(self, params):
+        # PaymentMethod.create sends the same params under another name.
+        params = _nested(params, 'credit_card') or _nested(params, 'payment_method')
+
+        if params.get('customer_id') not in self.customers:
+            return 404, ''
+        if params.get('token') in self.credit_cards:
+            return _error_response('credit_card', 'token', CREDIT_CARD_TOKEN_TAKEN,
+                                   'Token is in use.')
+
+        token = self._store_credit_card(params, params['customer_id'])
+        return 201, XmlUtil.xml_from_dict({'credit_card': self.credit_cards[token]})
+
+    def _find_credit_card(self, params, token):
+        if token not in self.credit_cards:
+            return 404, ''
+        return 200, XmlUtil.xml_from_dict({'credit_card': self.credit_cards[token]})
+
+    def _update_credit_card(self, params, token):
+        if token not in self.credit_cards:
+            return 404, ''
+
+        params = _nested(params, 'credit_card')
+        if params.get('expiration_date') or params.get('expiration_month'):
+            self.credit_cards[token].update(_expiration(params))
+
+        return 200, XmlUtil.xml_from_dict({'credit_card': self.credit_cards[token]})
+
+    def _delete_credit_card(self, params, token):
+        if token not in self.credit_cards:
+            return 404, ''
+
+        card = self.credit_cards.pop(token)
+        self.customers[card['customer_id']]['tokens'].remove(token)
+        return 200, ''
+
+    def _create_transaction(self, params):
+        params = _nested(params, 'transaction')
+        customer_params = _nested(params, 'customer')
+        card_params = _nested(params, 'credit_card')
+
+        customer_id = params.get('customer_id')
+        token = params.get('payment_method_token')
+
+        if customer_id is not None and customer_id not in self.customers:
+            return 404, ''
+        if token is not None and token not in self.credit_cards:
+            return 404, ''
+
+        if customer_params or card_params:
+            # The vault is only updated with store_in_vault, but it's harmless here.
+            customer_id = customer_id or customer_params.get('id') or _generated_id()
+            if customer_id not in self.customers:
+                self.customers[customer_id] = {'id': customer_id, 'tokens': []}
+            if card_params:
+                token = self._store_credit_card(card_params, customer_id)
+
+        if token is not None:
+            customer_id = self.credit_cards[token]['customer_id']
+
+        transaction = {
+            'id': _generated_id(),
+            'type': params.get('type', 'sale'),
+            'amount': params.get('amount'),
+            'status': 'authorized',
+        }
+        if customer_id is not None:
+            transaction['customer'] = {'id': customer_id}
+        if token is not None:
+            transaction['credit_card'] = dict(self.credit_cards[token])
+
+        self.transactions[transaction['id']] = transaction
+        return 201, XmlUtil.xml_from_dict({'transaction': transaction})
+
+    def _find_transaction(self, params, transaction_id):
+        if transaction_id not in self.transactions:
+            return 404, ''
+        return 200, XmlUtil.xml_from_dict({'transaction': self.transactions[transaction_id]})
+
+    def _transition(self, params, transaction_id, path):
+        if transaction_id not in self.transactions:
+            return 404, ''
+
+        status, from_statuses, code = _transitions[path]
+        transaction = self.transactions[transaction_id]
+        if transaction['status'] not in from_statuses:
+            return _error_response('transaction', 'base', code,
+                                   'Transaction can not be moved from %s to %s.'
+                                   % (transaction['status'], status))
+
+        transaction['status'] = status
+        return 200, XmlUtil.xml_from_dict({'transaction': transaction})
+
+    def _refund_transaction(self, params, transaction_id):
+        if transaction_id not in self.transactions:
+            return 404, ''
+
+        original = self.transactions[transaction_id]
+        if original['status'] not in ('settled', 'settlement_confirmed'):
+            return _error_response('transaction', 'base', CANNOT_REFUND_UNSETTLED,
+                                   'Cannot refund a transaction unless it is settled.')
+
+        amount = _nested(params, 'transaction').get('amount') or original['amount']
+        refund = dict(original, id=_generated_id(), type='credit', amount=amount,
+                      status='submitted_for_settlement', refunded_transaction_id=transaction_id)
+        self.transactions[refund['id']] = refund
+        return 201, XmlUtil.xml_from_dict({'transaction': refund})
+
+    def _update_transaction_details(self, params, transaction_id):
+        if transaction_id not in self.transactions:
+            return 404, ''
+
+        transaction = self.transactions[transaction_id]
+        if transaction['status'] != _SUBMITTED:
+            return _error_response('transaction', 'base', CANNOT_UPDATE_DETAILS,
+                                   'Transaction must be submitted for settlement to be updated.')
+
+        params = _nested(params, 'transaction')
+        for key in ('amount', 'order_id'):
+            if key in params:
+                transaction[key] = params[key]
+
+        return 200, XmlUtil.xml_from_dict({'transaction': transaction})
+
+    def _generate_client_token(self, params):
+        params = _nested(params, 'client_token')
+        customer_id = params.get('customer_id')
+
+        if customer_id is not None and customer_id not in self.customers:
+            return 422, XmlUtil.xml_from_dict({'api_error_response': {
+                'errors': {'errors': []},
+                'message': 'Customer specified by customer_id does not exist',
+                'params': {},
+            }})
+
+        return 201, XmlUtil.xml_from_dict({'client_token': {'value': _generated_id()}})
@@ -0,0 +1,58 @@
+from builtins import object
+import collections
+import io
+
+from .actions import convert_to_fake_id
+
+TraceEvent = collections.namedtuple('TraceEvent', ['fake_id', 'real_id', 'bt_class',
+                                                   'action', 'method'])
+
+
+class RewriteTrace(object):
+    """A bounded, in-memory record of id rewrites.
+
+    Provide an instance as the 'trace' option of a Namespace to enable it.
+    Recording only appends a tuple; events are not built or formatted until they're read.
+    """
+
+    def __init__(self, maxlen=1000):
+        self._records = collections.deque(maxlen=maxlen)
+
+    def record(self, before, after, resource_id, call_schema):
+        """Called by PatchedMethod after an action has run.
+
+        :param before: the id provided to the action
+        :param after: the id the action left in its place, or None if it was deleted
+        """
+        self._records.append((before, after, resource_id, call_schema))
+
+    def events(self):
+        """Return a list of TraceEvents, oldest first."""
+        events = []
+
+        for before, after, resource_id, call_schema in list(self._records):
+            if resource_id.action is convert_to_fake_id:
+                fake_id, real_id = after, before
+            else:
+                fake_id, real_id = before, after
+
+            events.append(TraceEvent(
+                fake_id, real_id, resource_id.bt_class, resource_id.action,
+                "%s.%s" % (call_schema.bt_class.__name__, call_schema.method_name)))
+
+        return events
+
+    def clear(self):
+        self._records.clear()
+
+    def __len__(self):
+        return len(self._records)
+
+    def dump(self, path):
+        """Write all events to the file at path, one per line."""
+
+        with io.open(path, 'w', encoding='utf-8') as f:
+            for event in self.events():
+                f.write(u"%s %s %s: fake_id=%r real_id=%r\n" % (
+                    event.method, event.action.__name__,
+                    event.bt_class.__name__, event.fake_id, event.real_id))
@@ -0,0 +1,97 @@
+from builtins import object
+import collections
+import functools
+import threading
+
+from braintree.environment import Environment
+from braintree.util.http import Http
+import requests
+
+ConnectionStats = collections.namedtuple('ConnectionStats', ['requests', 'connections', 'reused'])
+
+
+class PooledHttp(Http):
+    """A braintree http strategy which sends requests through a shared ConnectionPool."""
+
+    def __init__(self, config, environment, pool):
+        Http.__init__(self, config, environment)
+        self.pool = pool
+
+    def http_do(self, http_verb, path, headers, request_body):
+        data = request_body
+        files = None
+
+        if type(request_body) is tuple:
+            data = request_body[0]
+            files = request_body[1]
+
+        if not path.startswith(self.config.base_url()):
+            path = self.config.base_url() + path
+
+        if self.config.environment == Environment.Development:
+            verify = False
+        else:
+            verify = self.environment.ssl_certificate
+
+        response = self.pool.request(
+            http_verb, path,
+            headers=headers,
+            data=data,
+            files=files,
+            verify=verify,
+            timeout=self.config.timeout)
+
+        return [response.status_code, response.text]
+
+
+class ConnectionPool(object):
+    """Keep-alive connections shared by every braintree request made through it.
+
+    The braintree client otherwise opens new connections far more often than needed:
+    the class-level api builds a new Configuration (and http strategy) for every call.
+    """
+
+    def __init__(self, maxsize=10):
+        """
+        :param maxsize: the number of connections to keep open per host.
+        """
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=maxsize)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self._adapter = adapter
+        self._lock = threading.Lock()
+        self._requests = 0
+        # Connections opened before the pool was last closed.
+        self._closed_connections = 0
+
+    def http_strategy(self):
+        """Return a factory suitable for braintree's http_strategy configuration."""
+        return functools.partial(PooledHttp, pool=self)
+
+    def request(self, *args, **kwargs):
+        with self._lock:
+            self._requests += 1
+
+        return self.session.request(*args, **kwargs)
+
+    def stats(self):
+        """Return a ConnectionStats describing how often connections were reused."""
+
+        connections = self._closed_connections + self._open_connections()
+
+        return ConnectionStats(self._requests, connections,
+                               max(self._requests - connections, 0))
+
+    def _open_connections(self):
+        pools = self._adapter.poolmanager.pools
+        return sum(pools[key].num_connections for key in pools.keys())
+
+    def close(self):
+        """Close every open connection. The pool may still be used afterwards,
+        and its stats include connections it had before closing."""
+
+        self._closed_connections += self._open_connections()
+        self.session.close()
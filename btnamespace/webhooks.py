@@ -0,0 +1,34 @@
+import braintree
+
+
+def parse_notifications(notifications, gateway=None):
+    """Parse many webhook notifications with one gateway.
+
+    Each notification is still parsed and verified individually by
+    gateway.webhook_notification.parse; the only saving is that the gateway
+    (and its configuration) is built once for the batch rather than per call.
+
+    Inside a namespace, ids in the parsed notifications are mapped back to fake ids
+    just as they are for braintree.WebhookNotification.parse.
+
+    :param notifications: an iterable of (signature, payload) pairs, or of the dicts
+      returned by braintree.WebhookTesting.sample_notification.
+    :param gateway: (optional) the braintree.BraintreeGateway to parse with.
+      By default, one is built from the global Configuration.
+    :returns: a list of braintree.WebhookNotification, in the order they were provided.
+    """
+
+    if gateway is None:
+        gateway = braintree.Configuration.gateway()
+
+    parse = gateway.webhook_notification.parse
+    parsed = []
+
+    for notification in notifications:
+        if isinstance(notification, dict):
+            parsed.append(parse(notification['bt_signature'], notification['bt_payload']))
+        else:
+            signature, payload = notification
+            parsed.append(parse(signature, payload))
+
+    return parsed
@@ -43,6 +43,10 @@ setup(
         'future>=0.18.2',
         'mock',
     ],
+    entry_points={
+        'console_scripts': ['btnamespace-load = btnamespace.load:main'],
+        'pytest11': ['btnamespace = btnamespace.pytest_plugin'],
+    },
     license='MIT',
     zip_safe=False,
     classifiers=[
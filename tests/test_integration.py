@@ -4,12 +4,24 @@ from builtins import zip
 from builtins import str
 import copy
 import os
+import random
+import shutil
+import tempfile
+import threading
 import uuid
 
 import braintree
+import requests
+from mock import patch
 from unittest import TestCase, main
 
-from btnamespace import Namespace, NamespaceError
+from btnamespace import (ClientTokenCache, FindCache, Namespace, NamespaceError, RateLimiter,
+                         RewriteTrace, SingleFlight)
+from btnamespace import lifecycle, load, schemagen
+from btnamespace.patch import PatchedInit
+from btnamespace.schemas import schemas
+from btnamespace.standin import StandinGateway, uniform
+from btnamespace.webhooks import parse_notifications
 
 
 braintree.Configuration.configure(
@@ -29,6 +41,15 @@ def _ensure_user_exists(user_params):
     braintree.Customer.find(user_params['id'])
 
 
+def _sandbox_gateway():
+    return braintree.BraintreeGateway(braintree.Configuration(
+        braintree.Environment.Sandbox,
+        merchant_id=os.environ["BT_MERCHANT_ID"],
+        public_key=os.environ["BT_PUBLIC_KEY"],
+        private_key=os.environ["BT_PRIVATE_KEY"],
+    ))
+
+
 class ActionOutsideNamespaceTest(TestCase):
     def test_customer_operations_outside_of_namespace(self):
         with self.assertRaises(braintree.exceptions.NotFoundError):
@@ -48,12 +69,31 @@ class ActionOutsideNamespaceTest(TestCase):
 
 
 class NamespaceTest(TestCase):
+    # Arguments for the namespace each test runs in.
+    namespace_kwargs = {}
+
     def setUp(self):
-        self.namespace = Namespace()
+        self.namespace = Namespace(**self.namespace_kwargs)
         self.namespace.__enter__()
         self.addCleanup(self.namespace.__exit__)
 
 
+class PausedTest(NamespaceTest):
+    def test_calls_are_not_namespaced_while_paused(self):
+        with self.namespace.paused():
+            _ensure_user_exists({
+                'id': 'nonnamespaced',
+            })
+
+        self.namespace.options['strict_missing'] = True
+        with self.assertRaises(braintree.exceptions.NotFoundError):
+            braintree.Customer.find('nonnamespaced')
+
+        result = braintree.Customer.create({'id': 'nonnamespaced'})
+        self.assertTrue(result.is_success, result)
+        self.assertEqual(result.customer.id, 'nonnamespaced')
+
+
 class OptionsTest(NamespaceTest):
     def test_omit_options_gets_empty(self):
         namespace = Namespace()
@@ -101,6 +141,374 @@ class StrictMissingOptionTest(NamespaceTest):
             braintree.Customer.find('existing')
 
 
+class TraceOptionTest(NamespaceTest):
+    def setUp(self):
+        super(TraceOptionTest, self).setUp()
+        self.trace = RewriteTrace(maxlen=2)
+        self.namespace.options['trace'] = self.trace
+
+    def test_rewrites_are_recorded(self):
+        result = braintree.Customer.create({"id": "customer_id"})
+        self.assertTrue(result.is_success, result)
+
+        create_event, init_event = self.trace.events()
+        self.assertEqual(create_event.method, 'Customer.create')
+        self.assertEqual(create_event.fake_id, 'customer_id')
+        self.assertIsNone(create_event.real_id)
+
+        self.assertEqual(init_event.method, 'Customer.__init__')
+        self.assertEqual(init_event.fake_id, 'customer_id')
+        self.assertNotEqual(init_event.real_id, 'customer_id')
+
+    def test_buffer_is_bounded(self):
+        for _ in range(3):
+            braintree.Customer.create({})
+
+        self.assertEqual(len(self.trace), 2)
+
+    def test_dump(self):
+        braintree.Customer.create({"id": "customer_id"})
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'trace.log')
+        self.trace.dump(path)
+
+        with open(path) as f:
+            lines = f.readlines()
+        self.assertEqual(len(lines), 2)
+        self.assertIn('Customer.create', lines[0])
+
+
+class FindCacheOptionTest(NamespaceTest):
+    @classmethod
+    def setUpClass(cls):
+        # Schemas can't be generated while a namespace is active.
+        cls.cache_dir = tempfile.mkdtemp()
+        cls.generated_schemas = schemagen.generated_schemas(cls.cache_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.cache_dir)
+
+    def setUp(self):
+        super(FindCacheOptionTest, self).setUp()
+        self.cache = FindCache(maxsize=2)
+        self.namespace.options['find_cache'] = self.cache
+
+    def test_created_resources_are_cached(self):
+        result = braintree.Customer.create({"id": "customer_id", "first_name": "first"})
+        self.assertTrue(result.is_success, result)
+
+        customer = braintree.Customer.find("customer_id")
+        customer.first_name = "changed"
+
+        customer = braintree.Customer.find("customer_id")
+        self.assertEqual(customer.id, "customer_id")
+        self.assertEqual(customer.first_name, "first")
+        self.assertEqual(self.cache.stats().hits, 2)
+
+    def test_updates_invalidate(self):
+        braintree.Customer.create({"id": "customer_id", "first_name": "first"})
+        braintree.Customer.update("customer_id", {"first_name": "second"})
+
+        self.assertEqual(braintree.Customer.find("customer_id").first_name, "second")
+        self.assertEqual(self.cache.stats().misses, 1)
+
+    def test_deletes_invalidate(self):
+        braintree.Customer.create({"id": "customer_id"})
+        braintree.Customer.delete("customer_id")
+
+        with self.assertRaises(braintree.exceptions.NotFoundError):
+            braintree.Customer.find("customer_id")
+
+    def test_size_is_bounded(self):
+        for _ in range(3):
+            braintree.Customer.create({})
+
+        self.assertEqual(self.cache.stats().size, 2)
+
+    def test_reads_do_not_invalidate(self):
+        braintree.Customer.create({"id": "customer_id"})
+        braintree.ClientToken.generate({"customer_id": "customer_id"})
+
+        braintree.Customer.find("customer_id")
+        self.assertEqual(self.cache.stats(), (1, 0, 1))
+
+    def test_card_changes_invalidate_only_their_customer(self):
+        for customer_id in ["first_id", "second_id"]:
+            result = braintree.Customer.create({
+                "id": customer_id,
+                "credit_card": {
+                    "token": customer_id + "_token",
+                    "number": "4111111111111111",
+                    "expiration_date": "05/2015",
+                },
+            })
+            self.assertTrue(result.is_success, result)
+
+        result = braintree.CreditCard.update("first_id_token", {"cardholder_name": "changed"})
+        self.assertTrue(result.is_success, result)
+
+        braintree.Customer.find("second_id")
+        braintree.Customer.find("first_id")
+        self.assertEqual(self.cache.stats()[:2], (1, 1))
+
+    def test_created_cards_invalidate_their_customer(self):
+        braintree.Customer.create({"id": "customer_id"})
+        result = braintree.CreditCard.create({
+            "customer_id": "customer_id",
+            "token": "card_token",
+            "number": "4111111111111111",
+            "expiration_date": "05/2015",
+        })
+        self.assertTrue(result.is_success, result)
+
+        customer = braintree.Customer.find("customer_id")
+        self.assertEqual([card.token for card in customer.credit_cards], ["card_token"])
+
+    def _register_generated_schema(self, bt_class, method_name):
+        for call_schema in self.generated_schemas:
+            if (call_schema.bt_class, call_schema.method_name) == (bt_class, method_name):
+                self.namespace.register_schema(call_schema)
+
+    def test_transactions_invalidate_their_customer(self):
+        braintree.Customer.create({"id": "customer_id"})
+        braintree.Customer.find("customer_id")
+
+        result = braintree.Transaction.sale({
+            "amount": "10.00",
+            "customer_id": "customer_id",
+            "credit_card": {
+                "token": "card_token",
+                "number": "4111111111111111",
+                "expiration_date": "05/2030",
+            },
+            "options": {"store_in_vault": True},
+        })
+        self.assertTrue(result.is_success, result)
+
+        customer = braintree.Customer.find("customer_id")
+        self.assertEqual([card.token for card in customer.credit_cards], ["card_token"])
+
+    def test_payment_methods_invalidate_their_customer(self):
+        self._register_generated_schema(braintree.PaymentMethod, 'create')
+        braintree.Customer.create({"id": "customer_id"})
+        braintree.Customer.find("customer_id")
+
+        result = braintree.PaymentMethod.create({
+            "customer_id": "customer_id",
+            "payment_method_nonce": "fake-valid-nonce",
+            "token": "card_token",
+        })
+        self.assertTrue(result.is_success, result)
+
+        customer = braintree.Customer.find("customer_id")
+        self.assertEqual([card.token for card in customer.credit_cards], ["card_token"])
+
+    def test_generated_methods_invalidate(self):
+        self._register_generated_schema(braintree.Transaction, 'update_details')
+        result = braintree.Transaction.sale({
+            "amount": "10.00",
+            "credit_card": {
+                "number": "4111111111111111",
+                "expiration_date": "05/2030",
+            },
+        })
+        self.assertTrue(result.is_success, result)
+        transaction_id = result.transaction.id
+
+        braintree.Transaction.submit_for_settlement(transaction_id)
+        braintree.Transaction.find(transaction_id)
+
+        result = braintree.Transaction.update_details(transaction_id, {"amount": "5.00"})
+        self.assertTrue(result.is_success, result)
+
+        self.assertEqual(str(braintree.Transaction.find(transaction_id).amount), "5.00")
+
+
+class ClientTokenCacheOptionTest(NamespaceTest):
+    def setUp(self):
+        super(ClientTokenCacheOptionTest, self).setUp()
+        self.cache = ClientTokenCache(ttl=60, maxsize=2)
+        self.namespace.options['client_token_cache'] = self.cache
+
+        result = braintree.Customer.create({"id": "customer_id"})
+        self.assertTrue(result.is_success, result)
+
+    def test_tokens_are_reused(self):
+        token = braintree.ClientToken.generate({"customer_id": "customer_id"})
+
+        self.assertEqual(braintree.ClientToken.generate({"customer_id": "customer_id"}), token)
+        self.assertNotEqual(braintree.ClientToken.generate({}), token)
+        self.assertEqual(self.cache.stats().hits, 1)
+
+    def test_tokens_expire(self):
+        self.cache.ttl = 0
+        token = braintree.ClientToken.generate({"customer_id": "customer_id"})
+
+        self.assertNotEqual(braintree.ClientToken.generate({"customer_id": "customer_id"}), token)
+
+    def test_expiry_ignores_the_system_clock(self):
+        self.cache.put("key", "token")
+
+        with patch('time.time', return_value=0):
+            self.assertEqual(self.cache.get("key"), "token")
+
+        with patch('btnamespace.cache.monotonic', return_value=float('inf')):
+            self.assertIsNone(self.cache.get("key"))
+
+    def test_updates_invalidate(self):
+        token = braintree.ClientToken.generate({"customer_id": "customer_id"})
+        braintree.Customer.update("customer_id", {"first_name": "updated"})
+
+        self.assertNotEqual(braintree.ClientToken.generate({"customer_id": "customer_id"}), token)
+
+    def test_deletes_invalidate(self):
+        braintree.ClientToken.generate({"customer_id": "customer_id"})
+        braintree.Customer.delete("customer_id")
+
+        self.assertEqual(self.cache.stats().size, 0)
+
+
+class LocalDuplicatesOptionTest(NamespaceTest):
+    def setUp(self):
+        super(LocalDuplicatesOptionTest, self).setUp()
+        self.namespace.options['local_duplicates'] = True
+
+        result = braintree.Customer.create({
+            "id": "customer_id",
+            "credit_card": {
+                "token": "credit_card_token",
+                "number": "4111111111111111",
+                "expiration_date": "05/2030",
+            },
+        })
+        self.assertTrue(result.is_success, result)
+
+        # Only requests that reach the gateway take a token.
+        self.rate_limit = RateLimiter(rate=1000, burst=1000)
+        self.namespace.options['rate_limit'] = self.rate_limit
+
+    def test_duplicate_customer(self):
+        result = braintree.Customer.create({"id": "customer_id"})
+
+        self.assertFalse(result.is_success)
+        self.assertEqual(
+            result.errors.for_object("customer").on("id")[0].code,
+            braintree.ErrorCodes.Customer.IdIsInUse)
+        self.assertEqual(self.rate_limit.stats().requests, 0)
+
+    def test_duplicate_nested_credit_card(self):
+        result = braintree.Customer.create({
+            "id": "other_customer_id",
+            "credit_card": {
+                "token": "credit_card_token",
+                "number": "4111111111111111",
+                "expiration_date": "05/2030",
+            },
+        })
+
+        self.assertFalse(result.is_success)
+        errors = result.errors.for_object("customer").for_object("credit_card").on("token")
+        self.assertEqual(errors[0].code, braintree.ErrorCodes.CreditCard.TokenIsInUse)
+        self.assertEqual(self.rate_limit.stats().requests, 0)
+
+    def test_new_ids_are_created(self):
+        result = braintree.Customer.create({"id": "other_customer_id"})
+
+        self.assertTrue(result.is_success, result)
+        self.assertEqual(self.rate_limit.stats().requests, 1)
+
+
+class RateLimitOptionTest(NamespaceTest):
+    def test_requests_beyond_burst_are_delayed(self):
+        rate_limit = RateLimiter(rate=10, burst=2)
+        self.namespace.options['rate_limit'] = rate_limit
+
+        for _ in range(4):
+            braintree.Customer.create({})
+
+        stats = rate_limit.stats()
+        self.assertEqual(stats.requests, 4)
+        self.assertGreaterEqual(stats.delayed, 1)
+
+    def test_processes_share_a_lock_file(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        lock_path = os.path.join(tmpdir, 'bucket')
+
+        first = RateLimiter(rate=10, burst=1, lock_path=lock_path)
+        second = RateLimiter(rate=10, burst=1, lock_path=lock_path)
+
+        self.assertEqual(first.acquire(), 0)
+        self.assertGreater(second.acquire(), 0)
+
+    def test_invalid_rates(self):
+        for rate, burst in [(0, 1), (-1, 1), (10, 0)]:
+            with self.assertRaises(ValueError):
+                RateLimiter(rate=rate, burst=burst)
+
+
+class ConnectionPoolTest(TestCase):
+    def test_connections_are_reused(self):
+        namespace = Namespace(pool_size=2)
+
+        with namespace:
+            result = braintree.Customer.create({"id": "customer_id"})
+            self.assertTrue(result.is_success, result)
+
+            for _ in range(3):
+                braintree.Customer.find("customer_id")
+
+        stats = namespace.connection_pool.stats()
+        self.assertEqual(stats.requests, 4)
+        self.assertGreater(stats.reused, 0)
+
+        # Connections are closed on exit.
+        self.assertEqual(namespace.connection_pool._open_connections(), 0)
+
+    def test_strategy_is_removed_on_exit(self):
+        original_strategy = getattr(braintree.Configuration, 'default_http_strategy', None)
+
+        with Namespace(pool_size=2):
+            self.assertNotEqual(braintree.Configuration.default_http_strategy, original_strategy)
+
+        self.assertEqual(getattr(braintree.Configuration, 'default_http_strategy', None),
+                         original_strategy)
+
+
+class PatchInitTest(NamespaceTest):
+    def test_attributes_are_not_mutated(self):
+        braintree.Customer.create({"id": "customer_id"})
+        real_id, = self.namespace.to_real_ids(braintree.Customer, ["customer_id"])
+
+        attributes = {"id": real_id, "credit_cards": []}
+        customer = braintree.Customer(braintree.Configuration.gateway(), attributes)
+
+        self.assertEqual(customer.id, "customer_id")
+        self.assertEqual(attributes, {"id": real_id, "credit_cards": []})
+
+    def test_nested_ids_are_translated_as_resources_are_built(self):
+        result = braintree.Customer.create({
+            "id": "customer_id",
+            "credit_card": {
+                "token": "credit_card_token",
+                "number": "4111111111111111",
+                "expiration_date": "05/2030",
+            },
+        })
+        self.assertTrue(result.is_success, result)
+
+        customer = braintree.Customer.find("customer_id")
+
+        # Ids are rewritten as each resource is built, not when their attributes are read.
+        credit_card = customer.credit_cards[0]
+        self.assertEqual(vars(customer)["id"], "customer_id")
+        self.assertEqual(vars(credit_card)["token"], "credit_card_token")
+        self.assertEqual(vars(credit_card)["customer_id"], "customer_id")
+
+
 class PatchDeleteTest(NamespaceTest):
     def test_delete_customer(self):
         result = braintree.Customer.create({
@@ -536,6 +944,96 @@ class PatchCreditCardCreate(PatchCreateTest):
         self.assertTrue('second_id' in self.id_maps()[braintree.CreditCard].fake_id_for)
 
 
+class OwnedIdsTest(PatchCreateTest):
+    def test_created_ids_are_owned_in_creation_order(self):
+        for customer_id in ['first_id', 'second_id']:
+            customer_params = copy.copy(self.customer_params_no_id)
+            customer_params['id'] = customer_id
+            result = braintree.Customer.create(customer_params)
+            self.assertTrue(result.is_success, result)
+
+        created = self.namespace.created_ids(braintree.Customer)
+        self.assertEqual([fake_id for fake_id, _ in created], ['first_id', 'second_id'])
+        self.assertEqual(created[0][1], self.get_real_id(braintree.Customer, 'first_id'))
+        self.assertTrue(self.namespace.owns(braintree.Customer, 'second_id'))
+
+    def test_generated_ids_are_owned(self):
+        result = braintree.Customer.create(self.customer_params_no_id)
+        self.assertTrue(result.is_success, result)
+
+        customer_id = result.customer.id
+        self.assert_self_mapping(braintree.Customer, customer_id)
+        self.assertTrue(self.namespace.owns(braintree.Customer, customer_id))
+        self.assertEqual(self.namespace.created_ids(braintree.Customer),
+                         [(customer_id, customer_id)])
+
+    def test_nested_resources_are_owned(self):
+        customer_params = copy.copy(self.customer_params_no_id)
+        customer_params['credit_card'] = self.card_params_no_token
+        result = braintree.Customer.create(customer_params)
+        self.assertTrue(result.is_success, result)
+
+        card_token = result.customer.credit_cards[0].token
+        self.assertTrue(self.namespace.owns(braintree.CreditCard, card_token))
+
+    def test_found_resources_are_not_owned(self):
+        with self.namespace.paused():
+            result = braintree.Customer.create(self.customer_params_no_id)
+        self.assertTrue(result.is_success, result)
+
+        customer = braintree.Customer.find(result.customer.id)
+        self.assertFalse(self.namespace.owns(braintree.Customer, customer.id))
+        self.assertEqual(self.namespace.created_ids(braintree.Customer), [])
+
+
+class ResetTest(PatchCreateTest):
+    def test_reset_forgets_ids(self):
+        customer_params = copy.copy(self.customer_params_no_id)
+        customer_params['id'] = 'customer_id'
+
+        result = braintree.Customer.create(customer_params)
+        self.assertTrue(result.is_success, result)
+
+        self.namespace.reset()
+        self.assertEqual(self.namespace.created_ids(braintree.Customer), [])
+
+        with self.assertRaises(braintree.exceptions.NotFoundError):
+            braintree.Customer.find('customer_id')
+
+        # The id can be reused, since patches are still in place.
+        result = braintree.Customer.create(customer_params)
+        self.assertTrue(result.is_success, result)
+        self.assertEqual(result.customer.id, 'customer_id')
+
+
+class BulkTranslationTest(PatchCreateTest):
+    def test_translation_round_trips(self):
+        for customer_id in ['first_id', 'second_id']:
+            customer_params = copy.copy(self.customer_params_no_id)
+            customer_params['id'] = customer_id
+            braintree.Customer.create(customer_params)
+
+        real_ids = list(self.namespace.to_real_ids(
+            braintree.Customer, iter(['first_id', 'unknown_id', 'second_id'])))
+        self.assertEqual(real_ids[0], self.get_real_id(braintree.Customer, 'first_id'))
+        self.assertEqual(real_ids[1], 'unknown_id')
+
+        fake_ids = list(self.namespace.to_fake_ids(braintree.Customer, real_ids))
+        self.assertEqual(fake_ids, ['first_id', 'unknown_id', 'second_id'])
+
+    def test_missing_ids(self):
+        to_real_ids = self.namespace.to_real_ids
+
+        self.assertEqual(list(to_real_ids(braintree.Customer, ['unknown_id'], missing='none')),
+                         [None])
+        self.assertEqual(list(to_real_ids(braintree.Customer, ['unknown_id'], missing='skip')),
+                         [])
+        with self.assertRaises(KeyError):
+            list(to_real_ids(braintree.Customer, ['unknown_id'], missing='raise'))
+        with self.assertRaises(ValueError):
+            to_real_ids(braintree.Customer, ['unknown_id'], missing='ignore')
+
+
 class PatchAdvancedSearch(NamespaceTest):
     def test_customer_advanced_search_on_id(self):
         with self.assertRaises(NamespaceError):
@@ -591,6 +1089,592 @@ class PatchClientTokenGenerate(NamespaceTest):
         self.assertIsNotNone(client_token)
 
 
+class PatchWebhookTest(NamespaceTest):
+    def setUp(self):
+        super(PatchWebhookTest, self).setUp()
+
+        result = braintree.Transaction.sale({
+            "id": "txn_id",
+            "amount": "10.00",
+            "order_id": str(uuid.uuid4()),  # sidestep duplicate transaction validation
+            "credit_card": {
+                "number": "4111111111111111",
+                "expiration_date": "05/2015",
+                "cvv": "123"
+            },
+        })
+        self.assertTrue(result.is_success, result)
+
+    def test_sample_notification_round_trips_transaction_id(self):
+        sample = braintree.WebhookTesting.sample_notification(
+            braintree.WebhookNotification.Kind.TransactionSettled, 'txn_id')
+
+        notification = braintree.WebhookNotification.parse(
+            sample['bt_signature'], sample['bt_payload'])
+        self.assertEqual(notification.transaction.id, 'txn_id')
+
+    def test_transaction_review_id_is_rewritten(self):
+        sample = braintree.WebhookTesting.sample_notification(
+            braintree.WebhookNotification.Kind.TransactionReviewed, 'txn_id')
+
+        notification = braintree.WebhookNotification.parse(
+            sample['bt_signature'], sample['bt_payload'])
+        self.assertEqual(notification.transaction_review.transaction_id, 'txn_id')
+
+    def test_parse_notifications(self):
+        settled = braintree.WebhookTesting.sample_notification(
+            braintree.WebhookNotification.Kind.TransactionSettled, 'txn_id')
+        disbursed = braintree.WebhookTesting.sample_notification(
+            braintree.WebhookNotification.Kind.TransactionDisbursed, 'txn_id')
+
+        notifications = parse_notifications([
+            settled,
+            (disbursed['bt_signature'], disbursed['bt_payload']),
+        ])
+
+        self.assertEqual([n.kind for n in notifications], [
+            braintree.WebhookNotification.Kind.TransactionSettled,
+            braintree.WebhookNotification.Kind.TransactionDisbursed,
+        ])
+        self.assertEqual([n.transaction.id for n in notifications], ['txn_id', 'txn_id'])
+
+
+class ResponseEngineTest(NamespaceTest):
+    namespace_kwargs = {'engine': 'response'}
+
+    def test_init_is_not_patched(self):
+        self.assertNotIsInstance(braintree.Customer.__dict__['__init__'], PatchedInit)
+
+        result = braintree.Customer.create({"id": "customer_id"})
+        self.assertTrue(result.is_success, result)
+        self.assertEqual(result.customer.id, "customer_id")
+
+        # Only parsed responses are rewritten.
+        real_id, = self.namespace.to_real_ids(braintree.Customer, ["customer_id"])
+        customer = braintree.Customer(braintree.Configuration.gateway(), {"id": real_id})
+        self.assertEqual(customer.id, real_id)
+
+    def test_nested_resources_are_rewritten(self):
+        result = braintree.Customer.create({
+            "id": "customer_id",
+            "credit_card": {
+                "token": "card_token",
+                "number": "4111111111111111",
+                "expiration_date": "05/2015",
+            },
+        })
+        self.assertTrue(result.is_success, result)
+
+        card, = braintree.Customer.find("customer_id").credit_cards
+        self.assertEqual(card.token, "card_token")
+        self.assertEqual(card.customer_id, "customer_id")
+
+    def test_gateway_is_not_supported(self):
+        with self.assertRaises(ValueError):
+            Namespace(gateway=_sandbox_gateway(), engine='response')
+
+    def test_unknown_engine(self):
+        with self.assertRaises(ValueError):
+            Namespace(engine='unknown')
+
+
+class ResponseEngineFindTest(PatchFindTest):
+    namespace_kwargs = {'engine': 'response'}
+
+
+class ResponseEngineCustomerCreate(PatchCustomerCreate):
+    namespace_kwargs = {'engine': 'response'}
+
+
+class ResponseEngineTransactionCreate(PatchTransactionCreate):
+    namespace_kwargs = {'engine': 'response'}
+
+
+class ResponseEngineWebhookTest(PatchWebhookTest):
+    namespace_kwargs = {'engine': 'response'}
+
+
+class SchemaRegistryTest(NamespaceTest):
+    def setUp(self):
+        super(SchemaRegistryTest, self).setUp()
+
+        result = braintree.Customer.create({"id": "customer_id"})
+        self.assertTrue(result.is_success, result)
+
+    def test_unregister_unpatches_only_that_method(self):
+        find_schema = self.namespace.unregister_schema(braintree.Customer, 'find')
+        self.assertIsNone(self.namespace.get_schema(braintree.Customer, 'find'))
+        self.assertNotIn(find_schema, self.namespace.schemas)
+
+        with self.assertRaises(braintree.exceptions.NotFoundError):
+            braintree.Customer.find("customer_id")
+
+        result = braintree.Customer.update("customer_id", {"first_name": "updated"})
+        self.assertTrue(result.is_success, result)
+
+    def test_register_patches_an_active_namespace(self):
+        find_schema = self.namespace.unregister_schema(braintree.Customer, 'find')
+        self.namespace.register_schema(find_schema)
+
+        self.assertIs(self.namespace.get_schema(braintree.Customer, 'find'), find_schema)
+        self.assertEqual(braintree.Customer.find("customer_id").id, "customer_id")
+
+    def test_register_replaces_existing_schema(self):
+        find_schema = self.namespace.get_schema(braintree.Customer, 'find')
+        schema_count = len(self.namespace.schemas)
+
+        self.namespace.register_schema(find_schema._replace(start_hook=None))
+
+        self.assertEqual(len(self.namespace.schemas), schema_count)
+        self.assertEqual(braintree.Customer.find("customer_id").id, "customer_id")
+
+    def test_unregister_unknown_schema(self):
+        with self.assertRaises(KeyError):
+            self.namespace.unregister_schema(braintree.Customer, 'unknown')
+
+    def test_assigning_schemas_replaces_them(self):
+        kept = [self.namespace.get_schema(braintree.Customer, '__init__'),
+                self.namespace.get_schema(braintree.Customer, 'find')]
+
+        self.namespace.schemas = kept
+
+        self.assertEqual(self.namespace.schemas, kept)
+        self.assertIsNone(self.namespace.get_schema(braintree.Customer, 'create'))
+        self.assertEqual(braintree.Customer.find("customer_id").id, "customer_id")
+
+
+class PatchOnlyTest(TestCase):
+    def test_only_named_methods_are_patched(self):
+        namespace = Namespace(patch_only=[(braintree.Customer, 'create'),
+                                          (braintree.Customer, 'find')])
+        self.assertEqual(set((s.bt_class, s.method_name) for s in namespace.schemas),
+                         set([(braintree.Customer, '__init__'),
+                              (braintree.Customer, 'create'),
+                              (braintree.Customer, 'find'),
+                              (braintree.CreditCard, '__init__')]))
+
+        update = braintree.Customer.update
+        with namespace:
+            self.assertIs(braintree.Customer.update, update)
+
+            result = braintree.Customer.create({"id": "customer_id"})
+            self.assertTrue(result.is_success, result)
+            self.assertEqual(braintree.Customer.find("customer_id").id, "customer_id")
+
+    def test_created_nested_resources_are_rewritten(self):
+        with Namespace(patch_only=[(braintree.Customer, 'create')]):
+            result = braintree.Customer.create({
+                "id": "customer_id",
+                "credit_card": {
+                    "token": "credit_card_token",
+                    "number": "4111111111111111",
+                    "expiration_date": "05/2030",
+                },
+            })
+
+        self.assertTrue(result.is_success, result)
+        self.assertEqual(result.customer.credit_cards[0].token, "credit_card_token")
+
+    def test_classes_patch_all_their_methods(self):
+        namespace = Namespace(patch_only=[braintree.Transaction])
+        # Sales can create a customer and card, so only their __init__s are added.
+        self.assertEqual(set((s.bt_class, s.method_name) for s in namespace.schemas
+                             if s.bt_class is not braintree.Transaction),
+                         set([(braintree.Customer, '__init__'),
+                              (braintree.CreditCard, '__init__')]))
+        self.assertIn('create', [s.method_name for s in namespace.schemas])
+        self.assertIn('refund', [s.method_name for s in namespace.schemas])
+
+    def test_invalid_items(self):
+        with self.assertRaises(ValueError):
+            Namespace(patch_only=['Customer'])
+
+
+class GeneratedSchemasTest(TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+
+    def test_generated_schemas_are_cached(self):
+        generated = schemagen.generated_schemas(self.cache_dir)
+        self.assertTrue(os.path.exists(schemagen.cache_path(self.cache_dir)))
+
+        schemagen._loaded_schemas.clear()
+        self.assertEqual(schemagen.generated_schemas(self.cache_dir), generated)
+
+    def test_handwritten_schemas_are_not_generated(self):
+        handwritten = set((s.bt_class, s.method_name) for s in schemas)
+        generated = set((s.bt_class, s.method_name)
+                        for s in schemagen.generated_schemas(self.cache_dir))
+
+        self.assertEqual(handwritten & generated, set())
+        self.assertIn((braintree.PaymentMethod, 'create'), generated)
+        self.assertIn((braintree.Subscription, 'find'), generated)
+
+    def test_payment_method_create_and_find(self):
+        namespace = Namespace(
+            custom_schemas=schemas + schemagen.generated_schemas(self.cache_dir))
+
+        with namespace:
+            result = braintree.Customer.create({"id": "customer_id"})
+            self.assertTrue(result.is_success, result)
+
+            result = braintree.PaymentMethod.create({
+                "customer_id": "customer_id",
+                "payment_method_nonce": "fake-valid-nonce",
+                "token": "payment_method_token",
+            })
+            self.assertTrue(result.is_success, result)
+            self.assertEqual(result.payment_method.token, "payment_method_token")
+
+            payment_method = braintree.PaymentMethod.find("payment_method_token")
+            self.assertEqual(payment_method.customer_id, "customer_id")
+
+
+class GatewayNamespaceTest(TestCase):
+    def setUp(self):
+        self.gateways = [_sandbox_gateway(), _sandbox_gateway()]
+        self.namespaces = [Namespace(gateway=gateway) for gateway in self.gateways]
+
+        for namespace in self.namespaces:
+            namespace.__enter__()
+            self.addCleanup(namespace.__exit__)
+
+    def test_gateways_have_independent_namespaces(self):
+        for gateway in self.gateways:
+            result = gateway.customer.create({
+                "id": "customer_id",
+                "credit_card": {
+                    "token": "credit_card_token",
+                    "number": "4111111111111111",
+                    "expiration_date": "05/2015",
+                    "cvv": "123"
+                }
+            })
+            self.assertTrue(result.is_success, result)
+            self.assertEqual(result.customer.id, "customer_id")
+
+        real_ids = [namespace.created_ids(braintree.Customer)[0][1]
+                    for namespace in self.namespaces]
+        self.assertNotEqual(real_ids[0], real_ids[1])
+
+        for gateway in self.gateways:
+            customer = gateway.customer.find("customer_id")
+            self.assertEqual(customer.id, "customer_id")
+            self.assertEqual(customer.credit_cards[0].token, "credit_card_token")
+
+            card = gateway.credit_card.find("credit_card_token")
+            self.assertEqual(card.token, "credit_card_token")
+
+    def test_unbound_calls_are_not_namespaced(self):
+        result = self.gateways[0].customer.create({"id": "customer_id"})
+        self.assertTrue(result.is_success, result)
+
+        with self.assertRaises(braintree.exceptions.NotFoundError):
+            braintree.Customer.find("customer_id")
+
+    def test_exit_order_does_not_matter(self):
+        original_init = braintree.Customer.__dict__['__init__'].method
+
+        self.namespaces[0].__exit__()
+        self.namespaces[1].__exit__()
+        self.assertIs(braintree.Customer.__dict__['__init__'], original_init)
+
+    def test_extra_exit_does_not_unpatch_others(self):
+        self.namespaces[0].__exit__()
+        self.namespaces[0].__exit__()
+
+        result = self.gateways[1].customer.create({"id": "customer_id"})
+        self.assertTrue(result.is_success, result)
+        self.assertEqual(self.gateways[1].customer.find("customer_id").id, "customer_id")
+
+
+class ThreadSafeNamespaceTest(TestCase):
+    def setUp(self):
+        self.namespace = Namespace(thread_safe=True)
+        self.namespace.__enter__()
+        self.addCleanup(self.namespace.__exit__)
+
+    def test_concurrent_creates_and_finds(self):
+        errors = []
+
+        def create_and_find():
+            try:
+                for _ in range(3):
+                    result = braintree.Customer.create({})
+                    self.assertTrue(result.is_success, result)
+
+                    customer = braintree.Customer.find(result.customer.id)
+                    self.assertEqual(customer.id, result.customer.id)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=create_and_find) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+
+    def test_concurrent_finds_are_coalesced(self):
+        single_flight = SingleFlight()
+        self.namespace.options['single_flight'] = single_flight
+
+        # Requests go to a stand-in slow enough that every thread's find overlaps the first.
+        slow_requests = patch.object(braintree.Configuration, 'default_http_strategy',
+                                     StandinGateway(latency=.5).http_strategy(), create=True)
+        slow_requests.start()
+        self.addCleanup(slow_requests.stop)
+
+        braintree.Customer.create({"id": "customer_id", "first_name": "first"})
+
+        customers = []
+        threads = [threading.Thread(
+            target=lambda: customers.append(braintree.Customer.find("customer_id")))
+            for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([(customer.id, customer.first_name) for customer in customers],
+                         [("customer_id", "first")] * 8)
+        self.assertEqual(single_flight.stats(), (1, 7))
+
+    def test_concurrent_creates_map_their_own_ids(self):
+        errors = []
+
+        def create(customer_id):
+            try:
+                result = braintree.Customer.create({
+                    "id": customer_id,
+                    "credit_card": {
+                        "token": customer_id + "_token",
+                        "number": "4111111111111111",
+                        "expiration_date": "05/2015",
+                    }
+                })
+                self.assertTrue(result.is_success, result)
+                self.assertEqual(result.customer.id, customer_id)
+                self.assertEqual(result.customer.credit_cards[0].token, customer_id + "_token")
+            except Exception as e:
+                errors.append(e)
+
+        customer_ids = ["customer_id_%s" % i for i in range(4)]
+        threads = [threading.Thread(target=create, args=(customer_id,))
+                   for customer_id in customer_ids]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(fake_id for fake_id, _ in
+                                self.namespace.created_ids(braintree.Customer)),
+                         customer_ids)
+
+
+class DerivedIdsTest(TestCase):
+    def setUp(self):
+        self.id_token = uuid.uuid4().hex[:8]
+        self.namespace = Namespace(id_token=self.id_token)
+        self.namespace.__enter__()
+        self.addCleanup(self.namespace.__exit__)
+
+    def test_provided_ids_are_derived(self):
+        result = braintree.Customer.create({"id": "customer_id"})
+        self.assertTrue(result.is_success, result)
+        self.assertEqual(result.customer.id, "customer_id")
+
+        # Other namespaces with the same token resolve the same ids.
+        self.namespace.__exit__()
+        with Namespace(id_token=self.id_token):
+            self.assertEqual(braintree.Customer.find("customer_id").id, "customer_id")
+        self.namespace.__enter__()
+
+        # Fake ids starting with '=' are sent as-is.
+        customer = braintree.Customer.find("=%s_customer_id" % self.id_token)
+        self.assertEqual(customer.id, "customer_id")
+        self.assertEqual(self.namespace.created_ids(braintree.Customer), [])
+
+    def test_real_ids_need_the_marker(self):
+        result = braintree.Customer.create({"id": "customer_id"})
+        self.assertTrue(result.is_success, result)
+
+        # Without '=', a real id is taken as a provided id and derived again.
+        with self.assertRaises(braintree.exceptions.NotFoundError):
+            braintree.Customer.find(self.id_token + "_customer_id")
+
+    def test_generated_ids_round_trip(self):
+        result = braintree.Customer.create({})
+        self.assertTrue(result.is_success, result)
+        self.assertTrue(result.customer.id.startswith("="))
+
+        customer = braintree.Customer.find(result.customer.id)
+        self.assertEqual(customer.id, result.customer.id)
+
+    def test_long_ids_are_rejected(self):
+        with self.assertRaises(NamespaceError):
+            braintree.Customer.create({"id": "x" * 36})
+
+
+class TransactionLifecycleTest(TestCase):
+    def setUp(self):
+        self.namespace = Namespace(thread_safe=True)
+        self.namespace.__enter__()
+        self.addCleanup(self.namespace.__exit__)
+
+        result = braintree.Customer.create({
+            "id": "customer_id",
+            "credit_card": {
+                "token": "credit_card_token",
+                "number": "4111111111111111",
+                "expiration_date": "05/2030",
+            },
+        })
+        self.assertTrue(result.is_success, result)
+
+    def _sale(self):
+        result = braintree.Transaction.sale({
+            "amount": "10.00",
+            "payment_method_token": "credit_card_token",
+        })
+        self.assertTrue(result.is_success, result)
+        return result.transaction.id
+
+    def test_lifecycle_calls_are_namespaced(self):
+        transaction_id = self._sale()
+
+        result = braintree.Transaction.void(transaction_id)
+        self.assertTrue(result.is_success, result)
+        self.assertEqual(result.transaction.id, transaction_id)
+
+    def test_advance_transactions(self):
+        transaction_ids = [self._sale() for _ in range(4)]
+
+        results = lifecycle.advance_transactions(transaction_ids, lifecycle.REFUNDED, workers=4)
+
+        self.assertEqual([r.transaction_id for r in results], transaction_ids)
+        for transaction_id, result in zip(transaction_ids, results):
+            self.assertEqual(result.step, 'refund')
+            self.assertTrue(result.result.is_success, result.result)
+            self.assertEqual(result.result.transaction.refunded_transaction_id, transaction_id)
+
+        self.assertEqual(braintree.Transaction.find(transaction_ids[0]).status,
+                         braintree.Transaction.Status.Settled)
+
+    def test_advance_stops_at_failed_step(self):
+        transaction_id = self._sale()
+
+        result, = lifecycle.advance_transactions([transaction_id], ('settle', 'refund'))
+
+        self.assertEqual(result.step, 'settle')
+        self.assertFalse(result.result.is_success)
+
+
+class StandinGatewayTest(TestCase):
+    def setUp(self):
+        self.gateway = braintree.BraintreeGateway(braintree.Configuration(
+            braintree.Environment.Development, 'merchant_id', 'public_key', 'private_key',
+            http_strategy=StandinGateway().http_strategy()))
+
+        namespace = Namespace(gateway=self.gateway)
+        namespace.__enter__()
+        self.addCleanup(namespace.__exit__)
+
+    def test_namespaced_operations(self):
+        result = self.gateway.customer.create({
+            "id": "customer_id",
+            "credit_card": {
+                "token": "credit_card_token",
+                "number": "4111111111111111",
+                "expiration_date": "05/2015",
+            }
+        })
+        self.assertTrue(result.is_success, result)
+
+        result = self.gateway.transaction.sale({
+            "amount": "10.00",
+            "payment_method_token": "credit_card_token",
+        })
+        self.assertTrue(result.is_success, result)
+
+        transaction = self.gateway.transaction.find(result.transaction.id)
+        self.assertEqual(transaction.customer_details.id, "customer_id")
+        self.assertEqual(transaction.credit_card_details.token, "credit_card_token")
+
+        self.gateway.customer.delete("customer_id")
+        with self.assertRaises(braintree.exceptions.NotFoundError):
+            self.gateway.credit_card.find("credit_card_token")
+
+    def test_duplicate_ids_are_rejected(self):
+        self.gateway.customer.create({"id": "customer_id"})
+
+        result = self.gateway.customer.create({"id": "customer_id"})
+        self.assertFalse(result.is_success)
+
+
+class StandinConditionsTest(TestCase):
+    def _gateway(self, standin, **config):
+        return braintree.BraintreeGateway(braintree.Configuration(
+            braintree.Environment.Development, 'merchant_id', 'public_key', 'private_key',
+            http_strategy=standin.http_strategy(), **config))
+
+    def test_errors_are_injected(self):
+        gateway = self._gateway(StandinGateway(error_rate=1))
+
+        with self.assertRaises(braintree.exceptions.ServerError):
+            gateway.customer.create({})
+
+    def test_requests_beyond_max_rate_are_throttled(self):
+        standin = StandinGateway(max_rate=2)
+        gateway = self._gateway(standin)
+
+        gateway.customer.create({})
+        gateway.customer.create({})
+        with self.assertRaises(braintree.exceptions.TooManyRequestsError):
+            gateway.customer.create({})
+
+        self.assertEqual(standin.stats().throttled, 1)
+
+    def test_slow_requests_time_out(self):
+        standin = StandinGateway(latency=uniform(.2, .3))
+        gateway = self._gateway(standin, timeout=.1)
+
+        with self.assertRaises(requests.exceptions.ReadTimeout):
+            gateway.customer.create({})
+
+        self.assertEqual(standin.stats().timeouts, 1)
+
+
+class LoadReportTest(TestCase):
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(load.percentile(values, .5), 50)
+        self.assertEqual(load.percentile(values, .99), 99)
+        self.assertEqual(load.percentile([], .5), 0.0)
+
+    def test_missing_resources_are_skipped(self):
+        workload = load.Workload({"customer.find": 1}, random.Random(0))
+        workload.customer_create = lambda: False
+
+        sample = workload.run_one()
+        self.assertEqual(sample.error, load.NO_RESOURCE)
+
+        with tempfile.TemporaryFile('w+') as out:
+            load.report([sample], 1.0, out)
+            out.seek(0)
+            report = out.read()
+
+        self.assertIn("0 operations in 1.0s: 0.0 ops/s, 0 failed", report)
+        self.assertIn("1 skipped: no resource available", report)
+
+    def test_parse_mix(self):
+        self.assertEqual(load.parse_mix("customer.create=2,customer.find"),
+                         {"customer.create": 2, "customer.find": 1})
+
+
 class PatchAllTest(TestCase):
     @staticmethod
     def _get_current_methods():
@@ -0,0 +1,66 @@
+from __future__ import absolute_import
+
+pytest_plugins = ['pytester']
+
+# Runs against the stand-in, so no sandbox account is needed.
+SUITE = '''
+import braintree
+from btnamespace.standin import StandinGateway
+
+braintree.Configuration.configure(
+    braintree.Environment.Development, 'merchant_id', 'public_key', 'private_key',
+    http_strategy=StandinGateway().http_strategy())
+
+namespaces = []
+
+
+def create_customer(bt_namespace):
+    result = braintree.Customer.create({"id": "customer_id"})
+    assert result.is_success, result
+    assert result.customer.id == "customer_id"
+
+    # Only this test's customer is known to the namespace.
+    assert [fake_id for fake_id, _ in bt_namespace.created_ids(braintree.Customer)] == [
+        "customer_id"]
+    namespaces.append(bt_namespace)
+
+
+def test_first(bt_namespace):
+    create_customer(bt_namespace)
+
+
+def test_second(bt_namespace):
+    create_customer(bt_namespace)
+    assert namespaces[0] is namespaces[1]
+'''
+
+
+def _run(testdir, *args):
+    testdir.makepyfile(test_suite=SUITE)
+    # Load the plugin from this tree, whether or not its entry point is installed.
+    return testdir.runpytest_subprocess('-p', 'no:btnamespace',
+                                        '-p', 'btnamespace.pytest_plugin', *args)
+
+
+def test_each_test_gets_a_reset_namespace(testdir):
+    result = _run(testdir)
+    result.assert_outcomes(passed=2)
+
+
+def test_calls_are_reported(testdir):
+    result = _run(testdir, '--bt-calls-report=1')
+
+    result.assert_outcomes(passed=2)
+    result.stdout.fnmatch_lines([
+        '*braintree gateway calls*',
+        '2 calls in *',
+        '*1 calls  test_suite.py::test_*',
+    ])
+    assert len([line for line in result.stdout.lines if 'calls  test_suite.py' in line]) == 1
+
+
+def test_report_can_be_disabled(testdir):
+    result = _run(testdir, '--bt-calls-report=0')
+
+    result.assert_outcomes(passed=2)
+    assert 'braintree gateway calls' not in result.stdout.str()